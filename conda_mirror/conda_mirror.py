@@ -1,21 +1,54 @@
 import argparse
+import bisect
 import bz2
+import codecs
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import cProfile
+import errno
 import fnmatch
+import functools
 import hashlib
+import http.server
+import io
+import itertools
 import json
 import logging
 import multiprocessing
+import multiprocessing.util
+import operator
 import os
 import pdb
+import pstats
+import re
 import shutil
+import sqlite3
 import sys
 import tarfile
 import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
 from pprint import pformat
 
 import requests
 import yaml
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+    _ZSTD_ERRORS = (zstandard.ZstdError,)
+except ImportError:
+    zstandard = None
+    _ZSTD_ERRORS = ()
+
 logger = None
 
 DEFAULT_BAD_LICENSES = ['agpl', '']
@@ -26,6 +59,27 @@ DEFAULT_PLATFORMS = ['linux-64',
                      'win-64',
                      'win-32']
 
+# in order of increasing cost:
+# - size: stat the package and compare its size to the repodata
+# - hash: compare its md5 (or sha256) to the repodata. Packages without a
+#         hash in the repodata get the size and the deep structural check
+# - deep: compare all of the above and read info/index.json from the package
+VALIDATION_LEVELS = ['size', 'hash', 'deep']
+
+# the orders packages can be downloaded in
+# - name: by package name
+# - smallest-first: the smallest packages first, so that a few huge packages
+#   do not hold up all the others
+# - newest-first: the most recently built packages first
+# - whitelist-first: the packages that match the whitelist first
+DOWNLOAD_ORDERS = ['name', 'smallest-first', 'newest-first',
+                   'whitelist-first']
+
+# the file extensions of conda packages, and the section of repodata.json
+# that lists them
+PACKAGE_FORMATS = {'.tar.bz2': 'packages',
+                   '.conda': 'packages.conda'}
+
 
 def _maybe_split_channel(channel):
     """Split channel if it is fully qualified.
@@ -86,23 +140,294 @@ def _match(all_packages, key_glob_dict):
         (key, glob_value) tuples
 
     """
-    matched = dict()
-    key_glob_dict = {key.lower(): glob.lower()
-                     for key, glob
-                     in key_glob_dict.items()}
-    for pkg_name, pkg_info in all_packages.items():
-        matched_all = []
-        # normalize the strings so that comparisons are easier
-        for key, pattern in key_glob_dict.items():
-            name = str(pkg_info.get(key, '')).lower()
-            if fnmatch.fnmatch(name, pattern):
-                matched_all.append(True)
+    rules = _PackageRules([key_glob_dict])
+    return {pkg_name: pkg_info for pkg_name, pkg_info in all_packages.items()
+            if rules.matches(pkg_info)}
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def _is_comparison(pattern):
+    return pattern.strip()[:1] in ('<', '>', '=', '!')
+
+
+# metadata keys that are compared as numbers by the rules
+NUMERIC_KEYS = ('size', 'build_number', 'timestamp')
+
+# the keys that combine rules in the blacklist and whitelist
+RULE_GROUPS = ('all', 'any', 'not')
+
+_COMPARISON = re.compile(r'^(>=|<=|==|!=|=|>|<)\s*(\S+)$')
+
+
+@functools.total_ordering
+class _VersionOrder(object):
+    """Sort key for a conda version string
+
+    Follows the ordering of conda's VersionOrder: an optional epoch ("1!")
+    and local version ("+local") are split off, and the rest is split into
+    components on "." and "_". Each component is a run of numbers and
+    strings, where "dev" sorts before any other string, strings sort before
+    numbers and "post" sorts after everything. Missing components count as
+    0, so that 1.1 == 1.1.0 and 1.1.0rc1 < 1.1.
+
+    Parameters
+    ----------
+    version : str
+        A conda version, like '1.11.0rc1'
+    """
+
+    def __init__(self, version):
+        version = str(version).strip().lower()
+        if '-' in version and '_' not in version:
+            version = version.replace('-', '_')
+        epoch, _, version = version.rpartition('!')
+        version, _, local = version.partition('+')
+        self.epoch = int(epoch) if epoch.isdigit() else 0
+        self.version = self._split(version)
+        self.local = self._split(local)
+
+    @staticmethod
+    def _split(version):
+        components = []
+        for component in version.replace('_', '.').split('.'):
+            parts = re.findall(r'\d+|[^\d]+', component)
+            if not parts or not parts[0].isdigit():
+                parts.insert(0, '0')
+            components.append([_VersionOrder._rank(part) for part in parts])
+        return components
+
+    @staticmethod
+    def _rank(part):
+        if part.isdigit():
+            return (2, int(part))
+        if part == 'dev':
+            return (0, '')
+        if part == 'post':
+            return (3, '')
+        return (1, part)
+
+    @staticmethod
+    def _pad(a, b):
+        """Pad the lists of components `a` and `b` to the same length"""
+        zero = [(2, 0)]
+        length = max(len(a), len(b))
+        a = a + [zero] * (length - len(a))
+        b = b + [zero] * (length - len(b))
+        padded_a, padded_b = [], []
+        for x, y in zip(a, b):
+            length = max(len(x), len(y))
+            padded_a.append(tuple(x + zero * (length - len(x))))
+            padded_b.append(tuple(y + zero * (length - len(y))))
+        return padded_a, padded_b
+
+    def _keys(self, other):
+        version, other_version = self._pad(self.version, other.version)
+        local, other_local = self._pad(self.local, other.local)
+        return ((self.epoch, version, local),
+                (other.epoch, other_version, other_local))
+
+    def __eq__(self, other):
+        key, other_key = self._keys(other)
+        return key == other_key
+
+    def __lt__(self, other):
+        key, other_key = self._keys(other)
+        return key < other_key
+
+    def startswith(self, other):
+        """Whether the components of `other` are the first components of
+        this version, which is what conda's "=1.2" (or "1.2.*") matches"""
+        version, other_version = self._pad(self.version[:len(other.version)],
+                                           other.version)
+        return self.epoch == other.epoch and version == other_version
+
+
+_OPERATORS = {'>=': operator.ge, '<=': operator.le, '==': operator.eq,
+              '!=': operator.ne, '>': operator.gt, '<': operator.lt,
+              '=': _VersionOrder.startswith}
+
+
+def _compile_comparison(key, spec):
+    """Compile a comparison spec like '>=1.20,<2|==0.9' on `key`
+
+    Comparisons separated by "," all have to hold, and groups separated by
+    "|" are alternatives, like in conda's match specs. The values of the
+    NUMERIC_KEYS are compared as numbers and all other values as conda
+    versions. "==" and "!=" also take globs, like "==1.2.*". Like in conda,
+    "=1.2" matches 1.2 and every version that starts with it, like 1.2.3,
+    but not 1.20.
+
+    Returns
+    -------
+    condition : callable
+        Takes a function that looks up a (lower-cased) value of the package
+        metadata by key, and returns whether the comparison holds
+    """
+    convert = float if key in NUMERIC_KEYS else _VersionOrder
+    alternatives = []
+    for group in spec.split('|'):
+        comparisons = []
+        for comparison in group.split(','):
+            match = _COMPARISON.match(comparison.strip())
+            if match is None:
+                raise ValueError('Invalid comparison %r in %r for key %r' %
+                                 (comparison, spec, key))
+            op, operand = match.groups()
+            if op == '=':
+                if convert is float:
+                    op = '=='
+                elif operand.endswith('.*'):
+                    operand = operand[:-len('.*')]
+            if op in ('==', '!=') and _is_glob(operand):
+                regex = re.compile(fnmatch.translate(operand))
+                comparisons.append(
+                    (lambda value, regex=regex, negate=op == '!=':
+                        bool(regex.match(value)) != negate, None))
+                continue
+            try:
+                operand = convert(operand)
+            except ValueError:
+                raise ValueError('Invalid value %r in %r for key %r' %
+                                 (operand, spec, key))
+            comparisons.append((_OPERATORS[op], operand))
+        alternatives.append(comparisons)
+
+    def condition(value):
+        raw = value(key)
+        if not raw:
+            return False
+        try:
+            converted = convert(raw)
+        except ValueError:
+            return False
+        return any(all(op(raw) if operand is None else op(converted, operand)
+                       for op, operand in comparisons)
+                   for comparisons in alternatives)
+    return condition
+
+
+def _compile_rule(rule):
+    """Compile a blacklist or whitelist rule into a list of conditions
+
+    The values of the rule are globs, comparison specs (see
+    `_compile_comparison`) or, for the RULE_GROUPS keys, nested rules: 'all'
+    and 'any' take a list of rules and 'not' takes a rule or a list of rules
+    none of which may match.
+
+    Returns
+    -------
+    conditions : list of callables
+        Each condition takes a function that looks up a (lower-cased) value
+        of the package metadata by key. The rule matches a package when all
+        of them hold.
+    """
+    if not isinstance(rule, dict):
+        raise ValueError('Blacklist and whitelist rules have to be '
+                         'dictionaries, not %r' % (rule,))
+    conditions = []
+    for key, pattern in sorted(rule.items()):
+        key = key.lower()
+        if key in RULE_GROUPS:
+            rules = pattern if isinstance(pattern, list) else [pattern]
+            compiled = [_compile_rule(r) for r in rules]
+
+            def matches(value, compiled=compiled):
+                return [all(c(value) for c in conditions)
+                        for conditions in compiled]
+            if key == 'all':
+                conditions.append(lambda value, m=matches: all(m(value)))
+            elif key == 'any':
+                conditions.append(lambda value, m=matches: any(m(value)))
             else:
-                matched_all.append(False)
-        if all(matched_all):
-            matched.update({pkg_name: pkg_info})
+                conditions.append(lambda value, m=matches: not any(m(value)))
+            continue
+        pattern = str(pattern).lower()
+        if _is_comparison(pattern):
+            conditions.append(_compile_comparison(key, pattern))
+        else:
+            regex = re.compile(fnmatch.translate(pattern))
+            conditions.append(
+                lambda value, key=key, regex=regex: regex.match(value(key)))
+    return conditions
+
+
+class _PackageRules(object):
+    """A list of blacklist or whitelist rules compiled for matching
+
+    Each rule is a dict of (key, value) pairs and matches a package when all
+    of its values match the (lower-cased) values of the package metadata. A
+    package matches the rules when any of the rules matches. The values are
+    globs, like `_match` takes, comparisons like '>=1.20,<2' or, under the
+    'all', 'any' and 'not' keys, nested rules. See `_compile_rule`.
+
+    Rules with a literal value (no glob characters) are indexed on one of
+    their literal (key, value) pairs, preferring the package name, so they
+    cost a dict lookup per package no matter how many there are. Rules made
+    of a single glob are combined into one compiled regex per key. Only the
+    remaining rules are checked one by one.
+
+    Parameters
+    ----------
+    rules : iterable of dicts
+        The rules from the blacklist or whitelist
+    """
 
-    return matched
+    def __init__(self, rules):
+        # key -> {value: [remaining conditions of each rule]}
+        self._index = {}
+        # key -> single glob patterns on that key
+        globs = {}
+        # all other rules, as lists of conditions
+        self._rules = []
+        for rule in rules or ():
+            literals = {key.lower(): str(value).lower()
+                        for key, value in rule.items()
+                        if key.lower() not in RULE_GROUPS and
+                        not _is_glob(str(value)) and
+                        not _is_comparison(str(value))}
+            if literals:
+                key = 'name' if 'name' in literals else sorted(literals)[0]
+                remaining = {k: v for k, v in rule.items()
+                             if k.lower() != key}
+                self._index.setdefault(key, {}).setdefault(
+                    literals[key], []).append(_compile_rule(remaining))
+                continue
+            if len(rule) == 1:
+                (key, pattern), = rule.items()
+                pattern = str(pattern)
+                if key.lower() not in RULE_GROUPS and \
+                        not _is_comparison(pattern):
+                    globs.setdefault(key.lower(), []).append(
+                        fnmatch.translate(pattern.lower()))
+                    continue
+            self._rules.append(_compile_rule(rule))
+        self._globs = [(key, re.compile('|'.join(patterns)))
+                       for key, patterns in globs.items()]
+
+    def __bool__(self):
+        return bool(self._index or self._globs or self._rules)
+
+    def matches(self, pkg_info):
+        """Whether any of the rules matches the package metadata `pkg_info`"""
+        values = {}
+
+        def value(key):
+            if key not in values:
+                values[key] = str(pkg_info.get(key, '')).lower()
+            return values[key]
+
+        for key, rules in self._index.items():
+            if any(all(condition(value) for condition in conditions)
+                   for conditions in rules.get(value(key), ())):
+                return True
+        for key, regex in self._globs:
+            if regex.match(value(key)):
+                return True
+        return any(all(condition(value) for condition in conditions)
+                   for conditions in self._rules)
 
 
 def _make_arg_parser():
@@ -133,13 +458,16 @@ def _make_arg_parser():
             'Temporary download location for the packages. Defaults to a '
             'randomly selected temporary directory. Note that you might need '
             'to specify a different location if your default temp directory '
-            'has less available space than your mirroring target'),
+            'has less available space than your mirroring target. If it is '
+            'on another filesystem than target-directory, the packages are '
+            'downloaded to target-directory/.conda-mirror/staging instead'),
         default=tempfile.gettempdir()
     )
     ap.add_argument(
         '--platform',
-        help=("The OS platform(s) to mirror. one of: {'linux-64', 'linux-32',"
-              "'osx-64', 'win-32', 'win-64'}"),
+        nargs='+',
+        help=("The OS platform(s) to mirror. one or more of: {'linux-64', "
+              "'linux-32', 'osx-64', 'win-32', 'win-64'}"),
     )
     ap.add_argument(
         '-v', '--verbose',
@@ -166,6 +494,91 @@ def _make_arg_parser():
         type=int,
         help="Num of threads for validation. 1: Serial mode. 0: All available."
         )
+    ap.add_argument(
+        '--num-download-threads',
+        action="store",
+        default=4,
+        type=int,
+        help=("Num of concurrent package downloads. Independent of "
+              "--num-threads, which only applies to validation."),
+    )
+    ap.add_argument(
+        '--download-order',
+        choices=DOWNLOAD_ORDERS,
+        default='name',
+        help=("The order to download packages in. 'smallest-first' keeps a "
+              "few huge packages from holding up all the others. Defaults "
+              "to 'name'."),
+    )
+    ap.add_argument(
+        '--max-bandwidth',
+        action='append',
+        help=("Max combined download rate in bytes/sec, with an optional K, "
+              "M or G suffix. Prefix it with a time of day range to only "
+              "apply it then, like 09:00-17:00=2M. Can be given several "
+              "times."),
+    )
+    ap.add_argument(
+        '--max-connections-per-host',
+        action="store",
+        type=int,
+        help="Max number of concurrent package downloads from one host.",
+    )
+    ap.add_argument(
+        '--connection-pool-size',
+        action="store",
+        type=int,
+        help=("Max number of keep-alive connections to the upstream host. "
+              "Defaults to the number of download threads."),
+    )
+    ap.add_argument(
+        '--compression-threads',
+        action="store",
+        default=1,
+        type=int,
+        help=("Num of threads to compress repodata.json.bz2 with. More than "
+              "1 compresses blocks of it in parallel into a multi-stream bz2 "
+              "file."),
+    )
+    ap.add_argument(
+        '--blob-store',
+        help=("Directory to hardlink every mirrored package into, keyed by "
+              "its hash. Packages that are already in it, e.g. from another "
+              "platform or channel, are linked from it instead of "
+              "downloaded again."),
+    )
+    ap.add_argument(
+        '--cache-directory',
+        help=("Where to keep state between runs, like the last upstream "
+              "repodata. Defaults to a .conda-mirror directory in "
+              "target-directory"),
+    )
+    ap.add_argument(
+        '--metrics-file',
+        help=("Write Prometheus metrics of the run, like the time spent in "
+              "each phase and the download throughput, to this file. Point "
+              "the textfile collector of the node exporter at it, e.g. "
+              "/var/lib/node_exporter/conda_mirror.prom"),
+    )
+    ap.add_argument(
+        '--metrics-port',
+        type=int,
+        help=("Serve the Prometheus metrics of the run over http on this "
+              "port while it is going on"),
+    )
+    ap.add_argument(
+        '--metrics-host',
+        default='127.0.0.1',
+        help=("The address to serve the metrics on. Defaults to %(default)s, "
+              "use 0.0.0.0 to allow scraping them from other hosts"),
+    )
+    ap.add_argument(
+        '--profile',
+        help=("Profile each phase of the run, including the download "
+              "threads and validation processes, and write a pstats file "
+              "per phase and the collapsed stacks of all of them, for "
+              "flamegraph.pl, into this directory"),
+    )
     ap.add_argument(
         '--version',
         action="store_true",
@@ -185,9 +598,45 @@ def _make_arg_parser():
         help="Skip validation of files already present in target-directory",
         default=False,
     )
+    ap.add_argument(
+        '--validation-level',
+        choices=VALIDATION_LEVELS,
+        default='hash',
+        help=("How thoroughly to validate packages. 'size': compare the file "
+              "size to the repodata. 'hash': compare the md5. 'deep': also "
+              "read the package metadata from the archive. Defaults to "
+              "'hash'."),
+    )
+    ap.add_argument(
+        '--existing-validation-level',
+        choices=VALIDATION_LEVELS,
+        help=("Override --validation-level for the packages already in "
+              "target-directory"),
+    )
+    ap.add_argument(
+        '--new-validation-level',
+        choices=VALIDATION_LEVELS,
+        help="Override --validation-level for newly downloaded packages",
+    )
+    ap.add_argument(
+        '--no-validation-cache',
+        action="store_true",
+        help=("Validate every package again, instead of only the ones that "
+              "changed since they were last validated"),
+        default=False,
+    )
+    ap.add_argument(
+        '--incremental',
+        action="store_true",
+        help=("Only sync the packages that were added, removed or changed "
+              "upstream since the repodata.json written by the last run"),
+        default=False,
+    )
     ap.add_argument(
         '--minimum-free-space',
-        help=("Threshold for free diskspace. Given in megabytes."),
+        help=("Threshold for free diskspace. Given in megabytes. The "
+              "downloads are planned in --download-order up front and "
+              "packages that do not fit are skipped."),
         type=int,
         default=1000,
     )
@@ -276,11 +725,29 @@ def _parse_and_format_args():
         'temp_directory': args.temp_directory,
         'platform': args.platform,
         'num_threads': args.num_threads,
+        'num_download_threads': args.num_download_threads,
+        'connection_pool_size': args.connection_pool_size,
+        'download_order': args.download_order,
+        'max_bandwidth': args.max_bandwidth,
+        'max_connections_per_host': args.max_connections_per_host,
+        'compression_threads': args.compression_threads,
+        'cache_directory': args.cache_directory,
+        'blob_store': args.blob_store,
+        'metrics_file': args.metrics_file,
+        'metrics_port': args.metrics_port,
+        'metrics_host': args.metrics_host,
+        'profile': args.profile,
         'blacklist': blacklist,
         'whitelist': whitelist,
         'dry_run': args.dry_run,
         'no_validate_target': args.no_validate_target,
         'minimum_free_space': args.minimum_free_space,
+        'incremental': args.incremental,
+        'validation_cache': not args.no_validation_cache,
+        'existing_validation_level': (args.existing_validation_level or
+                                      args.validation_level),
+        'new_validation_level': (args.new_validation_level or
+                                 args.validation_level),
     }
 
 
@@ -312,10 +779,46 @@ def _remove_package(pkg_path, reason):
     return pkg_path, msg
 
 
-def _validate(filename, md5=None, size=None):
-    """Validate the conda package tarfile located at `filename` with any of the
-    passed in options `md5` or `size. Also implicitly validate that
-    the conda package is a valid tarfile.
+def _hash_file(filename, hashes, chunk_size=1024 * 1024, end=None):
+    """Feed the contents of `filename` into `hashes`, one chunk at a time
+
+    The chunks are read into a single preallocated buffer, so the memory used
+    does not depend on the size of the file.
+
+    Parameters
+    ----------
+    filename : str
+        The path to the file to hash
+    hashes : iterable
+        The hashlib objects to update
+    chunk_size : int, optional
+        The size of the buffer in bytes. Defaults to 1MB.
+    end : int, optional
+        Only hash the first `end` bytes of the file. Defaults to the whole file
+
+    Returns
+    -------
+    int
+        The number of bytes that were hashed
+    """
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    total = 0
+    with open(filename, 'rb', buffering=0) as f:
+        while end is None or total < end:
+            n = f.readinto(view if end is None else view[:end - total])
+            if not n:
+                break
+            for h in hashes:
+                h.update(view[:n])
+            total += n
+    return total
+
+
+def _validate(filename, md5=None, size=None, sha256=None, level='hash'):
+    """Validate the conda package located at `filename` with any of the
+    passed in options `md5`, `sha256` or `size`. Also implicitly validate that
+    the conda package is a valid tarfile (.tar.bz2) or zip archive (.conda).
 
     NOTE: Removes packages that fail validation
 
@@ -328,6 +831,12 @@ def _validate(filename, md5=None, size=None):
     size : int, optional
         if provided, stat the file at `filename` and make sure its size
         matches `size`
+    sha256 : str, optional
+        If provided and there is no `md5` (or `level` is 'deep'), compute the
+        sha256 of `filename` and compare to `sha256`
+    level : {'size', 'hash', 'deep'}, optional
+        How thoroughly to validate the package. See `VALIDATION_LEVELS`.
+        Defaults to 'hash'.
 
     Returns
     -------
@@ -336,64 +845,791 @@ def _validate(filename, md5=None, size=None):
     reason : str
         The reason why the package is being removed
     """
-    if md5:
-        calc = hashlib.md5(open(filename, 'rb').read()).hexdigest()
-        if calc == md5:
-            # If the MD5 matches, skip the other checks
-            return filename, None
-        else:
-            return _remove_package(
-                filename,
-                reason="Failed md5 validation. Expected: %s. Computed: %s"
-                % (calc, md5))
+    reason, _ = _check_package(filename, md5=md5, size=size, sha256=sha256,
+                               level=level)
+    if reason is not None:
+        return _remove_package(filename, reason=reason)
+    return filename, None
+
+
+def _check_package(filename, md5=None, size=None, sha256=None, level='hash'):
+    """Check the conda package at `filename`. See `_validate` for the
+    parameters.
 
+    Returns
+    -------
+    reason : str
+        The reason why the package failed validation. None if it passed.
+    bytes_read : int
+        The number of bytes of the package that had to be read
+    """
     if size and size != os.stat(filename).st_size:
-        return _remove_package(filename, reason="Failed size test")
+        return "Failed size test", 0
+    if level == 'size':
+        return None, 0
+
+    hashes = {}
+    if md5:
+        hashes[md5] = hashlib.md5()
+    if sha256 and (level == 'deep' or not md5):
+        hashes[sha256] = hashlib.sha256()
+    bytes_read = 0
+    if hashes:
+        bytes_read = _hash_file(filename, hashes.values())
+        for expected, h in hashes.items():
+            if h.hexdigest() != expected:
+                return ("Failed %s validation. Expected: %s. Computed: %s"
+                        % (h.name, expected, h.hexdigest())), bytes_read
+        if level == 'hash':
+            # If the hash matches, skip the other checks
+            return None, bytes_read
+
+    if filename.endswith('.conda'):
+        reason, structure_bytes_read = _check_conda_archive(filename)
+    else:
+        reason, structure_bytes_read = _check_tarball(filename)
+    return reason, bytes_read + structure_bytes_read
+
+
+def _check_tarball(filename):
+    """Check that info/index.json can be read from the .tar.bz2 package at
+    `filename`
+
+    Returns
+    -------
+    reason : str
+        The reason why the package failed validation. None if it passed.
+    bytes_read : int
+        The number of bytes of the package that had to be read
+    """
+    with open(filename, 'rb') as f:
+        try:
+            with tarfile.open(fileobj=f) as t:
+                t.extractfile('info/index.json').read().decode('utf-8')
+        except (tarfile.TarError, EOFError, KeyError, OSError):
+            logger.info("Validation failed because conda package is corrupted.",
+                        exc_info=True)
+            return "Tarfile read failure", f.tell()
+        return None, f.tell()
+
+
+def _check_conda_archive(filename):
+    """Check the structure of the .conda package at `filename`
+
+    A .conda package is a zip file with a small info-*.tar.zst member with
+    the package metadata and a big pkg-*.tar.zst member with the package
+    contents. Only the central directory of the zip and the info member are
+    read. If the `zstandard` package is installed, info/index.json is read
+    from the info member as well.
 
+    Returns
+    -------
+    reason : str
+        The reason why the package failed validation. None if it passed.
+    bytes_read : int
+        The number of bytes of the package that had to be read
+    """
+    bytes_read = 0
     try:
-        with tarfile.open(filename) as t:
-            t.extractfile('info/index.json').read().decode('utf-8')
-    except (tarfile.TarError, EOFError):
+        with zipfile.ZipFile(filename) as z:
+            bytes_read = os.path.getsize(filename) - z.start_dir
+            names = z.namelist()
+            info_members = fnmatch.filter(names, 'info-*.tar.zst')
+            if len(info_members) != 1 or not fnmatch.filter(names,
+                                                            'pkg-*.tar.zst'):
+                return "Missing .conda archive members", bytes_read
+            bytes_read += z.getinfo(info_members[0]).compress_size
+            # reading the member checks its CRC
+            info = z.read(info_members[0])
+        if zstandard is not None:
+            with zstandard.ZstdDecompressor().stream_reader(
+                    io.BytesIO(info)) as reader:
+                with tarfile.open(fileobj=reader, mode='r|') as t:
+                    for member in t:
+                        if member.name == 'info/index.json':
+                            t.extractfile(member).read().decode('utf-8')
+                            break
+                    else:
+                        return "Missing info/index.json", bytes_read
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, KeyError,
+            OSError) + _ZSTD_ERRORS:
         logger.info("Validation failed because conda package is corrupted.",
                     exc_info=True)
-        return _remove_package(filename, reason="Tarfile read failure")
+        return "Zipfile read failure", bytes_read
+    return None, bytes_read
 
-    return filename, None
 
+def _make_session(pool_size=10):
+    """Make an http session that keeps connections alive and reuses them
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        The maximum number of connections kept open per host. Should be at
+        least the number of concurrent requests made through the session.
+        Defaults to 10.
+
+    Returns
+    -------
+    requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _session_stats(session):
+    """Count the connections opened and requests served by `session`
+
+    Parameters
+    ----------
+    session : requests.Session
+        A session created by `_make_session`
+
+    Returns
+    -------
+    dict
+        keys are:
+        - opened : the number of connections that were opened
+        - requests : the number of requests that were sent over them
+    """
+    stats = {'opened': 0, 'requests': 0}
+    # the same adapter is mounted for http and https
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['opened'] += pool.num_connections
+            stats['requests'] += pool.num_requests
+    return stats
+
+
+def _repodata_cache_path(cache_directory, url):
+    """The path that the repodata at `url` is cached at in `cache_directory`
+
+    Parameters
+    ----------
+    cache_directory : str
+        The directory that conda-mirror keeps its state in between runs
+    url : str
+        The url of a repodata.json
+
+    Returns
+    -------
+    str
+        The path to the cached repodata.json. Its ETag and Last-Modified
+        headers are stored next to it, with a '.meta' suffix
+    """
+    key = hashlib.md5(url.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(cache_directory, 'repodata', key + '.json')
+
+
+# the package metadata keys that are stored in the slots of _PackageRecord
+_RECORD_FIELDS = ('arch', 'build', 'build_number', 'constrains', 'depends',
+                  'features', 'license', 'license_family', 'md5', 'name',
+                  'noarch', 'platform', 'sha256', 'size', 'subdir',
+                  'timestamp', 'track_features', 'version')
+
+# the values of these keys are unique to each package, so interning them
+# would only cost memory
+_UNIQUE_FIELDS = ('md5', 'sha256')
+
+
+class _PackageRecord(collections.abc.Mapping):
+    """The read-only metadata of one package from repodata.json
+
+    Behaves like the metadata dict, but the common keys are kept in slots
+    instead of a dict per package, repeated strings (like license, subdir or
+    the depends entries) are interned, and lists are kept as tuples that are
+    shared between packages with the same ones. The records of a channel are
+    created once by `get_repodata`, and all the dicts of packages built from
+    them refer to the same records. Use `dict(record)` to get a dict back.
+
+    Parameters
+    ----------
+    pkg_info : dict
+        The package metadata from repodata.json
+    tuples : dict, optional
+        Cache of the tuples created so far, to share them between records
+    """
+    __slots__ = _RECORD_FIELDS + ('_extra',)
+
+    def __init__(self, pkg_info, tuples=None):
+        if tuples is None:
+            tuples = {}
+        extra = None
+        for key, value in pkg_info.items():
+            if isinstance(value, str):
+                if key not in _UNIQUE_FIELDS:
+                    value = sys.intern(value)
+            elif isinstance(value, list):
+                value = tuple(sys.intern(v) if isinstance(v, str) else v
+                              for v in value)
+                try:
+                    value = tuples.setdefault(value, value)
+                except TypeError:
+                    # unhashable items, like nested dicts
+                    pass
+            if key in _RECORD_FIELDS:
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[sys.intern(key)] = value
+        self._extra = extra
+
+    def __getitem__(self, key):
+        if key in _RECORD_FIELDS:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is not None and key in self._extra:
+            value = self._extra[key]
+        else:
+            raise KeyError(key)
+        if isinstance(value, tuple):
+            return list(value)
+        return value
+
+    def __iter__(self):
+        for key in _RECORD_FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '_PackageRecord(%r)' % dict(self)
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# what may follow a complete number, true, false or null
+_JSON_DELIMITERS = frozenset(' \t\n\r,:]}')
+
+
+class _JSONStream(object):
+    """Read a JSON document one value at a time from chunks of bytes
+
+    Only the chunks needed for the next value are decoded and buffered, so
+    that a big document never has to be in memory at once.
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+        The utf-8 encoded JSON document
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read(self):
+        """Add the next chunk to the buffer. Returns False at the end."""
+        if self._eof:
+            return False
+        # drop what was parsed already
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        try:
+            self._buffer += self._utf8.decode(next(self._chunks))
+        except StopIteration:
+            self._buffer += self._utf8.decode(b'', final=True)
+            self._eof = True
+        return True
+
+    def _peek(self):
+        """Skip whitespace and return the next character, '' at the end"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                return ''
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError('Expected %r but found %r in JSON document' %
+                             (char, found))
+        self._pos += 1
+
+    def value(self):
+        """Parse the next value"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+                # a number that is not followed by a delimiter, like 1 of
+                # 1.5 when the chunk ends after it, might continue in the
+                # next chunk. Strings, objects and arrays end themselves.
+                if (self._eof or self._buffer[self._pos] in '"{[' or
+                        (end < len(self._buffer) and
+                         self._buffer[end] in _JSON_DELIMITERS)):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            # read at least as much again as is buffered before trying again,
+            # so that long values are not parsed over and over
+            pending = len(self._buffer) - self._pos
+            while (len(self._buffer) - self._pos < 2 * pending and
+                   self._read()):
+                pass
+
+    def members(self):
+        """Iterate over the keys of the next object
+
+        The value of each key has to be read (with `value` or `members`)
+        before moving on to the next key.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            separator = self._peek()
+            self._pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError('Expected \',\' or \'}\' but found %r in '
+                                 'JSON document' % separator)
+
+    def close(self):
+        """Make sure nothing but whitespace follows the document and read
+        the chunks to the end"""
+        if self._peek() != '':
+            raise ValueError('Extra data after the end of the JSON document')
+
+
+def _parse_repodata(chunks, platform, blacklist=None, whitelist=None,
+                    blacklisted=None):
+    """Parse repodata.json one package at a time
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+        The contents of repodata.json
+    platform : str
+        The subdir to record for the packages that do not have one
+    blacklist, whitelist : iterable of dicts, optional
+        The packages that match the blacklist and not the whitelist are left
+        out. See `main`.
+    blacklisted : set, optional
+        The names of the packages that were left out are added to it
 
-def get_repodata(channel, platform):
+    Returns
+    -------
+    info : dict
+    packages : dict
+        `_PackageRecord`s of the packages in all the PACKAGE_FORMATS sections,
+        keyed on package name
+    """
+    blacklist = _PackageRules(blacklist)
+    whitelist = _PackageRules(whitelist)
+    sections = set(PACKAGE_FORMATS.values())
+    info = {}
+    packages = {}
+    tuples = {}
+    stream = _JSONStream(chunks)
+    for key in stream.members():
+        if key not in sections:
+            value = stream.value()
+            if key == 'info':
+                info = value
+            continue
+        for pkg_name in stream.members():
+            pkg_info = stream.value()
+            # Patch the repodata.json so that all package info dicts contain
+            # a "subdir" key.  Apparently some channels on anaconda.org do
+            # not contain the 'subdir' field. I think this this might be
+            # relegated to the Continuum-provided channels only, actually.
+            pkg_info.setdefault('subdir', platform)
+            if (blacklist and blacklist.matches(pkg_info) and
+                    not whitelist.matches(pkg_info)):
+                if blacklisted is not None:
+                    blacklisted.add(pkg_name)
+                continue
+            packages[pkg_name] = _PackageRecord(pkg_info, tuples)
+    stream.close()
+    return info, packages
+
+
+def get_repodata(channel, platform, session=None, cache_directory=None,
+                 stats=None, blacklist=None, whitelist=None, blacklisted=None):
     """Get the repodata.json file for a channel/platform combo on anaconda.org
 
+    The compressed repodata.json.zst (if the `zstandard` package is
+    installed) or repodata.json.bz2 is preferred over repodata.json if the
+    channel has it. A compressed variant that the server answers with any
+    4xx status for is skipped. It is decompressed and parsed one package at a time while
+    it is downloaded.
+
     Parameters
     ----------
     channel : str
         anaconda.org/CHANNEL
     platform : {'linux-64', 'linux-32', 'osx-64', 'win-32', 'win-64'}
         The platform of interest
+    session : requests.Session, optional
+        The session to fetch the repodata with. Defaults to a new connection.
+    cache_directory : str, optional
+        If provided, keep a copy of the repodata in this directory and only
+        download it again if it changed upstream, according to its ETag or
+        Last-Modified header.
+    stats : dict, optional
+        If provided, information about the fetch is stored in here:
+        - url : the url the repodata was fetched from
+        - not_modified : True if the cached copy was used
+        - etag, last_modified : the validators of the repodata, if cached
+        - transferred_bytes : the number of bytes that were downloaded
+        - decoded_bytes : the size of the decompressed repodata.json
+    blacklist, whitelist : iterable of dicts, optional
+        The packages that match the blacklist and not the whitelist are left
+        out of `packages`. See `main`.
+    blacklisted : set, optional
+        If provided, the names of the packages that were left out are added
+        to it
 
     Returns
     -------
     info : dict
     packages : dict
-        keyed on package name (e.g., twisted-16.0.0-py35_0.tar.bz2)
+        `_PackageRecord`s keyed on package name (e.g.,
+        twisted-16.0.0-py35_0.tar.bz2). Both the .tar.bz2 packages from the
+        'packages' section of repodata.json and the .conda packages from its
+        'packages.conda' section are in here.
+    """
+    if stats is None:
+        stats = {}
+    return _parse_repodata(
+        _open_repodata(channel, platform, session, cache_directory, stats),
+        platform, blacklist=blacklist, whitelist=whitelist,
+        blacklisted=blacklisted)
+
+
+def _open_repodata(channel, platform, session, cache_directory, stats):
+    """Request the repodata of `channel` for `platform`
+
+    See `get_repodata` for the parameters. Whether the cached copy is still
+    current is known in `stats` once this returns, so the caller can decide
+    whether the repodata needs to be read at all.
+
+    Returns
+    -------
+    iterator of bytes
+        Chunks of the contents of repodata.json
     """
     url_template, channel = _maybe_split_channel(channel)
     url = url_template.format(channel=channel, platform=platform,
                               file_name='repodata.json')
+    stats.update(url=url, not_modified=False, etag=None, last_modified=None,
+                 transferred_bytes=0, decoded_bytes=0)
+    return _fetch_repodata(url, session, cache_directory, stats)
+
+
+def _repodata_variants(url):
+    """The urls to try to fetch the repodata.json at `url` from, in order of
+    preference, along with their compression"""
+    variants = [(url + '.bz2', 'bz2'), (url, None)]
+    if zstandard is not None:
+        variants.insert(0, (url + '.zst', 'zst'))
+    return variants
+
+
+def _iter_decompressed(chunks, compression):
+    """Decompress `chunks` of a file compressed with `compression` one at a
+    time, so the compressed file never needs to be held in memory"""
+    if compression is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    if compression == 'zst':
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        decompressor = bz2.BZ2Decompressor()
+    for chunk in chunks:
+        # bz2 files can be made up of several concatenated streams
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = b''
+            if compression == 'bz2' and decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
 
-    resp = requests.get(url).json()
-    info = resp.get('info', {})
-    packages = resp.get('packages', {})
-    # Patch the repodata.json so that all package info dicts contain a "subdir"
-    # key.  Apparently some channels on anaconda.org do not contain the
-    # 'subdir' field. I think this this might be relegated to the
-    # Continuum-provided channels only, actually.
-    for pkg_name, pkg_info in packages.items():
-        pkg_info.setdefault('subdir', platform)
-    return info, packages
+
+def _fetch_repodata(url, session, cache_directory, stats):
+    """Fetch the repodata at `url`, unless the cached copy is still current
+
+    See `get_repodata` for the parameters. The request is made right away,
+    but `stats` is only complete once all the chunks were read.
+
+    Returns
+    -------
+    iterator of bytes
+        Chunks of the contents of repodata.json
+    """
+    meta = {}
+    cache_path = None
+    if cache_directory is not None:
+        cache_path = _repodata_cache_path(cache_directory, url)
+        try:
+            with open(cache_path + '.meta') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if not os.path.exists(cache_path):
+            meta = {}
+
+    variants = _repodata_variants(url)
+    # try the variant we got last time first, that is what the validators
+    # are for
+    variants.sort(key=lambda variant: variant[0] != meta.get('url'))
+    for variant_url, compression in variants:
+        headers = {}
+        if variant_url == meta.get('url'):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        resp = (session or requests).get(variant_url, headers=headers,
+                                         stream=True)
+        # channels on object stores like S3 answer 403 instead of 404 for
+        # files that do not exist
+        if 400 <= resp.status_code < 500 and compression is not None:
+            logger.debug('%s is not available (%s)', variant_url,
+                         resp.status_code)
+            resp.close()
+            continue
+        resp.raise_for_status()
+        break
+    stats['url'] = variant_url
+
+    if resp.status_code == 304:
+        logger.info('repodata at %s has not changed. Using cached copy %s',
+                    variant_url, cache_path)
+        resp.close()
+        stats.update(not_modified=True, etag=meta.get('etag'),
+                     last_modified=meta.get('last_modified'))
+        return _iter_cached_repodata(cache_path, stats)
+    return _iter_repodata_response(resp, variant_url, compression, cache_path,
+                                   stats)
+
+
+def _iter_cached_repodata(cache_path, stats):
+    """Read the cached repodata at `cache_path` in chunks"""
+    with open(cache_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            stats['decoded_bytes'] += len(chunk)
+            yield chunk
+
+
+def _iter_repodata_response(resp, variant_url, compression, cache_path,
+                            stats):
+    """Read and decompress the repodata in the response `resp` to a request
+    for `variant_url` in chunks, and keep a copy of it at `cache_path` if
+    that is not None"""
+    logger.info('Downloading repodata from %s', variant_url)
+    with resp:
+        chunks = _iter_decompressed(resp.iter_content(64 * 1024), compression)
+        if cache_path is None:
+            for chunk in chunks:
+                stats['decoded_bytes'] += len(chunk)
+                yield chunk
+        else:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # write to a temporary file first so that an interrupted run
+            # never leaves a truncated cache behind
+            with open(cache_path + '.tmp', 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    stats['decoded_bytes'] += len(chunk)
+                    yield chunk
+            os.replace(cache_path + '.tmp', cache_path)
+            with open(cache_path + '.meta', 'w') as f:
+                json.dump({'url': variant_url,
+                           'etag': resp.headers.get('ETag'),
+                           'last_modified': resp.headers.get('Last-Modified')},
+                          f)
+        stats.update(etag=resp.headers.get('ETag'),
+                     last_modified=resp.headers.get('Last-Modified'),
+                     transferred_bytes=resp.raw.tell())
+    logger.info('Transferred %s bytes for %s bytes of repodata',
+                stats['transferred_bytes'], stats['decoded_bytes'])
+
+
+# from linux/fs.h: share the blocks of another file, on filesystems that
+# support reflinks (like btrfs and xfs)
+_FICLONE = 0x40049409
+
+
+def _copy_file(src, dst):
+    """Copy the file `src` to `dst` as cheaply as the OS allows
+
+    Tries a reflink first, which copies no data at all, then
+    `os.copy_file_range`, which copies the data inside the kernel, and falls
+    back to a plain copy.
+    """
+    with open(src, 'rb', buffering=0) as fsrc, \
+            open(dst, 'wb', buffering=0) as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, 'copy_file_range'):
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                           size - copied)
+                    if not n:
+                        break
+                    copied += n
+            except OSError:
+                pass
+            if copied == size:
+                return
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def _move(src, dst):
+    """Move the file `src` to `dst`
+
+    A rename if both are on the same filesystem, otherwise a `_copy_file`.
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        logger.debug('%s and %s are on different filesystems. Copying.',
+                     src, dst)
+        _copy_file(src, dst)
+        os.remove(src)
 
 
-def _download(url, target_directory):
+class _BlobStore(object):
+    """Content-addressed store of the packages mirrored so far
+
+    Every package is hardlinked into the store under its sha256 and its md5,
+    so that a package with the same contents that shows up in another
+    platform or channel can be linked from the store instead of being
+    downloaded and stored again.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the store. Hardlinks only work if it is on the same
+        filesystem as the target directories.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _blob_paths(self, metadata):
+        for algorithm in ('sha256', 'md5'):
+            digest = metadata.get(algorithm)
+            if digest:
+                yield os.path.join(self.path, algorithm, digest[:2], digest)
+
+    def link(self, metadata, path):
+        """Link the blob with the hash in the package `metadata` to `path`
+
+        Falls back to `_copy_file` (which reflinks where it can) if the blob
+        cannot be hardlinked. The linked package is hashed, since a blob
+        shares its contents with every package that was linked to it, and any
+        of them could have been corrupted since. A blob that does not match
+        its hash any more is removed from the store.
+
+        Returns
+        -------
+        bool
+            Whether the store had the blob and it passed validation
+        """
+        for blob_path in self._blob_paths(metadata):
+            try:
+                blob_size = os.path.getsize(blob_path)
+            except OSError:
+                continue
+            if metadata.get('size') not in (None, blob_size):
+                continue
+            try:
+                os.link(blob_path, path)
+            except OSError:
+                _copy_file(blob_path, path)
+            reason, _ = _check_package(
+                path, md5=metadata.get('md5'), size=metadata.get('size'),
+                sha256=metadata.get('sha256'), level='hash')
+            if reason is None:
+                return True
+            logger.warning('Removing %s from the blob store: %s', blob_path,
+                           reason)
+            os.remove(path)
+            os.remove(blob_path)
+        return False
+
+    def add(self, metadata, path):
+        """Add the package at `path` with the hash in `metadata` to the
+        store"""
+        for blob_path in self._blob_paths(metadata):
+            if os.path.exists(blob_path):
+                continue
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                os.link(path, blob_path)
+            except FileExistsError:
+                # added by another platform in the meantime
+                pass
+            except OSError as e:
+                logger.debug('Could not add %s to the blob store: %s', path, e)
+                return
+
+
+def _staging_directory(temp_directory, target_directory):
+    """The directory to download packages to before they are moved into
+    `target_directory`
+
+    That is `temp_directory`, unless it is on another filesystem than
+    `target_directory`. Then every package would be copied once more when it
+    is published, so a directory on the filesystem of `target_directory` is
+    used instead, to make publishing a rename.
+    """
+    if os.stat(temp_directory).st_dev == os.stat(target_directory).st_dev:
+        return temp_directory
+    staging_directory = os.path.join(target_directory, '.conda-mirror',
+                                     'staging')
+    os.makedirs(staging_directory, exist_ok=True)
+    logger.info('%s is on another filesystem than %s. Downloading to %s '
+                'instead.', temp_directory, target_directory,
+                staging_directory)
+    return staging_directory
+
+
+def _download(url, target_directory, session=None, partial_directory=None,
+              md5=None, sha256=None, size=None, scheduler=None):
     """Download `url` to `target_directory`
 
     Parameters
@@ -402,29 +1638,578 @@ def _download(url, target_directory):
         The url to download
     target_directory : str
         The path to a directory where `url` should be downloaded
+    session : requests.Session, optional
+        The session to download with. Defaults to a new connection.
+    partial_directory : str, optional
+        A persistent directory to keep incomplete downloads in. If given,
+        `url` is downloaded there first and moved to `target_directory` once
+        it is complete. A download that was interrupted is resumed with an
+        http Range request, unless the server ignores the Range or the file
+        changed upstream, in which case it starts over from byte 0.
+    md5 : str, optional
+        If provided, compute the md5 of the file while it is downloaded and
+        compare it to `md5`
+    sha256 : str, optional
+        If provided, compute the sha256 of the file while it is downloaded and
+        compare it to `sha256`
+    size : int, optional
+        If provided, make sure the downloaded file is `size` bytes long
+    scheduler : _DownloadScheduler, optional
+        If provided, the download is throttled to its bandwidth limit
 
     Returns
     -------
     file_size: int
         The size in bytes of the file that was downloaded
+    reason : str
+        The reason why the downloaded file failed validation and was removed.
+        None if it passed (or no `md5`, `sha256` or `size` was given).
     """
     file_size = 0
-    chunk_size = 1024  # 1KB chunks
+    chunk_size = 64 * 1024  # 64KB chunks
     logger.info("download_url=%s", url)
     # create a temporary file
     target_filename = url.split('/')[-1]
     download_filename = os.path.join(target_directory, target_filename)
-    logger.debug('downloading to %s', download_filename)
-    with open(download_filename, 'w+b') as tf:
-        ret = requests.get(url, stream=True)
+    if partial_directory is None:
+        partial_filename = download_filename
+        resume_from = 0
+        validator = None
+    else:
+        partial_filename = os.path.join(partial_directory,
+                                        target_filename + '.part')
+        resume_from, validator = _partial_download_state(partial_filename,
+                                                         url)
+    headers = {}
+    if resume_from:
+        logger.debug('resuming %s from byte %s', partial_filename, resume_from)
+        headers['Range'] = 'bytes=%s-' % resume_from
+        headers['If-Range'] = validator
+    logger.debug('downloading to %s', partial_filename)
+    ret = (session or requests).get(url, stream=True, headers=headers)
+    if ret.status_code == 416:
+        # the partial file is no prefix of the upstream file any more
+        ret.close()
+        resume_from = 0
+        ret = (session or requests).get(url, stream=True)
+    ret.raise_for_status()
+    if resume_from and not _is_resumed_response(ret, resume_from, validator):
+        logger.debug('server did not resume %s. Starting over.', url)
+        resume_from = 0
+    if partial_directory is not None:
+        _write_partial_download_state(partial_filename, url, ret)
+    hashes = {}
+    if md5:
+        hashes[md5] = hashlib.md5()
+    if sha256:
+        hashes[sha256] = hashlib.sha256()
+    if resume_from:
+        # the bytes we already have need to go into the hashes too
+        _hash_file(partial_filename, hashes.values(), end=resume_from)
+    with open(partial_filename, 'r+b' if resume_from else 'w+b') as tf:
+        tf.truncate(resume_from)
+        tf.seek(resume_from)
         for data in ret.iter_content(chunk_size):
+            if scheduler is not None:
+                scheduler.throttle(len(data))
             tf.write(data)
-        file_size = os.path.getsize(download_filename)
-    return file_size
+            for h in hashes.values():
+                h.update(data)
+            file_size += len(data)
+    file_size += resume_from
+    if partial_directory is not None:
+        _move(partial_filename, download_filename)
+        os.remove(partial_filename + '.json')
+
+    reason = None
+    if size and size != file_size:
+        reason = "Failed size test. Expected: %s. Downloaded: %s" % (
+            size, file_size)
+    for expected, h in hashes.items():
+        if reason is None and h.hexdigest() != expected:
+            reason = "Failed %s validation. Expected: %s. Computed: %s" % (
+                h.name, expected, h.hexdigest())
+    if reason is not None:
+        _remove_package(download_filename, reason=reason)
+    return file_size, reason
+
+
+def _partial_download_state(partial_filename, url):
+    """Figure out whether a previous download of `url` can be resumed
+
+    Parameters
+    ----------
+    partial_filename : str
+        The path an interrupted download of `url` would have been left at
+    url : str
+        The url that is being downloaded
+
+    Returns
+    -------
+    resume_from : int
+        The byte offset to resume the download from. 0 if it cannot be resumed
+    validator : str
+        The ETag or Last-Modified header that the partial download was started
+        with. None if it cannot be resumed
+    """
+    try:
+        with open(partial_filename + '.json') as f:
+            state = json.load(f)
+        resume_from = os.path.getsize(partial_filename)
+    except (OSError, ValueError):
+        return 0, None
+    # weak etags cannot be used for range requests
+    etag = state.get('etag')
+    if etag and etag.startswith('W/'):
+        etag = None
+    validator = etag or state.get('last_modified')
+    if state.get('url') != url or not validator or not resume_from:
+        return 0, None
+    return resume_from, validator
+
+
+def _write_partial_download_state(partial_filename, url, response):
+    """Record what is needed to resume the download of `url` later on"""
+    state = {'url': url,
+             'etag': response.headers.get('ETag'),
+             'last_modified': response.headers.get('Last-Modified')}
+    with open(partial_filename + '.json', 'w') as f:
+        json.dump(state, f)
+
+
+def _is_resumed_response(response, resume_from, validator):
+    """Check that `response` continues a download at byte `resume_from`
+
+    Servers that do not support Range requests, or whose copy of the file
+    changed since the download started, answer with the full file instead.
+    """
+    if response.status_code != 206:
+        return False
+    content_range = response.headers.get('Content-Range', '')
+    if not content_range.startswith('bytes %s-' % resume_from):
+        return False
+    etag = response.headers.get('ETag')
+    if etag and validator.startswith('"') and etag != validator:
+        return False
+    return True
+
+
+_RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def _parse_bandwidth_limits(limits):
+    """Parse bandwidth limits like '10M' or '09:00-17:00=2M'
+
+    Parameters
+    ----------
+    limits : str, int or iterable of them
+        Rates in bytes per second, with an optional K, M or G suffix. Rates
+        prefixed with a time of day range only apply in that range, the
+        others apply the rest of the day.
+
+    Returns
+    -------
+    default : float
+        The rate outside of the time ranges. None if unlimited.
+    windows : list
+        (start, end, rate) tuples with start and end in minutes since
+        midnight
+    """
+    if isinstance(limits, (str, int, float)):
+        limits = [limits]
+    default = None
+    windows = []
+    for limit in limits or ():
+        window, _, rate = str(limit).strip().rpartition('=')
+        match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMG]?)B?$', rate.upper())
+        if match is None:
+            raise ValueError('Invalid bandwidth limit %r' % limit)
+        rate = float(match.group(1)) * _RATE_UNITS[match.group(2)]
+        if not window:
+            default = rate
+            continue
+        match = re.match(r'^(\d\d?):(\d\d)-(\d\d?):(\d\d)$', window)
+        if match is None:
+            raise ValueError('Invalid time of day range %r in bandwidth limit '
+                             '%r' % (window, limit))
+        start_hour, start_minute, end_hour, end_minute = map(int,
+                                                             match.groups())
+        windows.append((start_hour * 60 + start_minute,
+                        end_hour * 60 + end_minute, rate))
+    return default, windows
+
+
+class _DownloadScheduler(object):
+    """Limit the bandwidth and the connections per host of the downloads
+
+    The bandwidth is shared by all downloads through a token bucket that
+    holds up to a second worth of bytes. One instance can be shared by all
+    the downloads of a run.
+
+    Parameters
+    ----------
+    bandwidth_limits : iterable, optional
+        See `_parse_bandwidth_limits`. Defaults to no limit.
+    max_connections_per_host : int, optional
+        The maximum number of concurrent downloads from one host. Defaults to
+        no limit.
+    """
+
+    def __init__(self, bandwidth_limits=None, max_connections_per_host=None):
+        self._default_rate, self._windows = _parse_bandwidth_limits(
+            bandwidth_limits)
+        self.max_connections_per_host = max_connections_per_host
+        self._lock = threading.Lock()
+        self._tokens = 0.
+        self._last_refill = time.monotonic()
+        self._host_slots = {}
+
+    def _rate(self):
+        """The bandwidth limit that applies right now"""
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self._windows:
+            if (start <= minute < end if start <= end
+                    else minute >= start or minute < end):
+                return rate
+        return self._default_rate
+
+    def throttle(self, num_bytes):
+        """Wait until `num_bytes` more bytes may be downloaded"""
+        rate = self._rate()
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens +
+                               (now - self._last_refill) * rate, rate)
+            self._last_refill = now
+            # go into debt and wait it off, so that concurrent downloads
+            # queue up behind each other
+            self._tokens -= num_bytes
+            wait = -self._tokens / rate
+        if wait > 0:
+            time.sleep(wait)
+
+    @contextlib.contextmanager
+    def connection(self, url):
+        """Hold one of the connections to the host of `url` while in this
+        context"""
+        if not self.max_connections_per_host:
+            yield
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            slots = self._host_slots.setdefault(
+                host, threading.Semaphore(self.max_connections_per_host))
+        with slots:
+            yield
+
+
+def _order_downloads(package_names, packages, order='name', whitelist=None):
+    """Sort the packages to download according to one of the
+    DOWNLOAD_ORDERS
+
+    Parameters
+    ----------
+    package_names : iterable
+        The names of the packages to download
+    packages : dict
+        The package metadata, keyed on package name
+    order : str, optional
+        One of DOWNLOAD_ORDERS. Defaults to 'name'. Ties are broken by name.
+    whitelist : iterable of dicts, optional
+        The whitelist, for the 'whitelist-first' order
+
+    Returns
+    -------
+    list
+        The package names in the order they should be downloaded in
+    """
+    if order == 'smallest-first':
+        def key(name):
+            return packages[name].get('size') or 0
+    elif order == 'newest-first':
+        def key(name):
+            return -(packages[name].get('timestamp') or 0)
+    elif order == 'whitelist-first':
+        rules = _PackageRules(whitelist)
+
+        def key(name):
+            return not rules.matches(packages[name])
+    elif order == 'name':
+        def key(name):
+            return 0
+    else:
+        raise ValueError('Unknown download order %r. Expected one of %s' %
+                         (order, DOWNLOAD_ORDERS))
+    return sorted(package_names, key=lambda name: (key(name), name))
+
+
+# the upper bounds of the download throughput histogram, in bytes per second
+THROUGHPUT_BUCKETS = [64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2,
+                      16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2,
+                      float('inf')]
+
+
+def _add_download_stats(stats, file_size, seconds):
+    """Account for a download of `file_size` bytes that took `seconds`"""
+    for key in ('files', 'bytes', 'seconds'):
+        stats.setdefault(key, 0)
+    stats['files'] += 1
+    stats['bytes'] += file_size
+    stats['seconds'] += seconds
+    histogram = stats.setdefault('throughput', {
+        'buckets': [0] * len(THROUGHPUT_BUCKETS), 'sum': 0.})
+    if seconds:
+        throughput = file_size / seconds
+        histogram['buckets'][bisect.bisect_left(THROUGHPUT_BUCKETS,
+                                                throughput)] += 1
+        histogram['sum'] += throughput
+
+
+class _DiskBudget(object):
+    """Plan the downloads of a run against the free disk space
+
+    Packages are downloaded to a staging directory first and only moved to
+    the target directory later on, so every package needs to fit into both
+    of them, but only once if they are on the same filesystem. The space of
+    the planned packages is reserved until their bytes are on disk, so that
+    one instance can be shared by all the platforms of a run: in the staging
+    directory until they are downloaded and in the target directory until
+    they are published.
+
+    Parameters
+    ----------
+    minimum_free_space : int
+        Threshold in bytes for the free space in the download and target
+        directories
+    """
+
+    def __init__(self, minimum_free_space=0):
+        self.minimum_free_space = minimum_free_space
+        self._lock = threading.Lock()
+        # bytes reserved on each device, and the reservations of each path
+        self._reserved = collections.Counter()
+        self._reservations = {}
+
+    def plan(self, package_names, packages, download_dir, local_directory):
+        """Pick the packages that fit into the free disk space
+
+        Packages are considered in the order of `package_names`, so that the
+        download order decides which packages are left out. A package that
+        does not fit is skipped, but smaller packages after it may still be
+        planned. Packages without a `size` in their repodata are assumed to
+        take no space.
+
+        Parameters
+        ----------
+        package_names : iterable
+            The package file names to download, most important first
+        packages : dict
+            The `packages` section of the repodata
+        download_dir : str
+            The path to the directory the packages are downloaded into
+        local_directory : str
+            The path to the directory the packages will be moved to
+
+        Returns
+        -------
+        planned : list
+            The package names to download, in the order they were given
+        skipped : list
+            The package names that did not fit into the free disk space
+        """
+        devices = collections.OrderedDict()
+        for directory in (download_dir, local_directory):
+            devices.setdefault(os.stat(directory).st_dev, directory)
+        planned = []
+        skipped = []
+        with self._lock:
+            budget = {
+                device: (shutil.disk_usage(directory).free -
+                         self.minimum_free_space - self._reserved[device])
+                for device, directory in devices.items()}
+            for package_name in package_names:
+                size = packages[package_name].get('size') or 0
+                if any(size > free for free in budget.values()):
+                    skipped.append(package_name)
+                    continue
+                for device in budget:
+                    budget[device] -= size
+                    self._reserved[device] += size
+                self._reservations[local_directory, package_name] = [
+                    (device, size) for device in budget]
+                planned.append(package_name)
+        for device, directory in devices.items():
+            if budget[device] < 0:
+                logger.error('Disk space below threshold in %s', directory)
+        return planned, skipped
+
+    def staged(self, local_directory, package_name, download_dir):
+        """Give back the space reserved in `download_dir` for a package once
+        it was downloaded, since its bytes are counted as used from then on
+
+        If `download_dir` is on the filesystem of `local_directory`, that is
+        all of the space that was reserved for the package.
+        """
+        device = os.stat(download_dir).st_dev
+        with self._lock:
+            reservation = self._reservations.get(
+                (local_directory, package_name), [])
+            for entry in [entry for entry in reservation
+                          if entry[0] == device]:
+                reservation.remove(entry)
+                self._reserved[device] -= entry[1]
+
+    def release(self, local_directory, package_name):
+        """Give back the space reserved for a package once it was published
+        to `local_directory`"""
+        with self._lock:
+            for device, size in self._reservations.pop(
+                    (local_directory, package_name), ()):
+                self._reserved[device] -= size
+
+    @contextlib.contextmanager
+    def reserving(self, local_directory):
+        """Give back the space that is still reserved for `local_directory`
+        on exit, e.g. for packages that failed to download"""
+        try:
+            yield self
+        finally:
+            with self._lock:
+                for key in [key for key in self._reservations
+                            if key[0] == local_directory]:
+                    for device, size in self._reservations.pop(key):
+                        self._reserved[device] -= size
+
+
+def _download_packages(urls, download_dir, num_download_threads=1,
+                       session=None, partial_directory=None,
+                       package_repodata=None, executor=None, scheduler=None,
+                       stats=None, disk_budget=None, local_directory=None,
+                       level='hash'):
+    """Download `urls` into `download_dir` using a bounded pool of threads
+
+    Errors are isolated to the package that raised them: they are logged and
+    the remaining downloads carry on. The disk space is not checked here, see
+    `_DiskBudget` to plan which packages fit.
+
+    Packages whose repodata has a hash are validated while they are being
+    downloaded, so that they do not need to be read back from disk. At the
+    'size' validation level only their size is checked.
+
+    Parameters
+    ----------
+    urls : iterable
+        The urls to download, in the order they should be started
+    download_dir : str
+        The path to a directory where the packages should be downloaded
+    num_download_threads : int, optional
+        Number of concurrent downloads. Defaults to `1` (i.e. serial
+        downloads). Ignored if `executor` is given.
+    session : requests.Session, optional
+        The session shared by all downloads. Defaults to a new connection per
+        download.
+    partial_directory : str, optional
+        A persistent directory to keep incomplete downloads in so that they
+        can be resumed. Defaults to downloading straight into `download_dir`.
+    package_repodata : dict, optional
+        The contents of repodata.json, used to validate the packages
+    executor : concurrent.futures.Executor, optional
+        The pool of threads to share with other downloads
+    scheduler : _DownloadScheduler, optional
+        The bandwidth and connection limits to share with other downloads
+    stats : dict, optional
+        If provided, the number of `files` and `bytes` that were downloaded
+        and the `seconds` the downloads took are added to it, as well as the
+        throughput of each download to the histogram in `throughput`. See
+        THROUGHPUT_BUCKETS.
+    disk_budget : _DiskBudget, optional
+        If provided, the space it reserved in `download_dir` for the packages
+        planned for `local_directory` is given back as they are downloaded
+    local_directory : str, optional
+        The directory the packages will be published to
+    level : {'size', 'hash', 'deep'}, optional
+        How thoroughly the packages are going to be validated. See
+        `VALIDATION_LEVELS`. Defaults to 'hash'.
+
+    Returns
+    -------
+    downloaded : set
+        Set of (url, download_dir) for each package that was downloaded
+    validated : set
+        Set of (pkg_path, reason) for each package that was validated while
+        it was downloaded. Packages where reason=None passed validation, the
+        others were removed.
+    """
+    downloaded = set()
+    validated = set()
+    lock = threading.Lock()
+    if scheduler is None:
+        scheduler = _DownloadScheduler()
+
+    def _download_one(url):
+        package_name = url.split('/')[-1]
+        package_metadata = (package_repodata or {}).get(package_name, {})
+        md5 = sha256 = None
+        if level != 'size':
+            md5 = package_metadata.get('md5')
+            sha256 = package_metadata.get('sha256')
+        try:
+            with scheduler.connection(url):
+                start_time = time.monotonic()
+                file_size, reason = _download(
+                    url, download_dir, session=session,
+                    partial_directory=partial_directory, md5=md5,
+                    sha256=sha256, size=package_metadata.get('size'),
+                    scheduler=scheduler)
+                seconds = time.monotonic() - start_time
+        except Exception as ex:
+            logger.exception('Unexpected error downloading %s: %s', url, ex)
+            return
+        if disk_budget is not None:
+            disk_budget.staged(local_directory, package_name, download_dir)
+        with lock:
+            if stats is not None:
+                _add_download_stats(stats, file_size, seconds)
+            # the size check is all there is to the 'size' level
+            if md5 or sha256 or reason is not None or level == 'size':
+                validated.add((os.path.join(download_dir, package_name),
+                               reason))
+            downloaded.add((url, download_dir))
+
+    if executor is None:
+        num_download_threads = max(num_download_threads or 1, 1)
+        logger.info('Will use %s threads for package download.',
+                    num_download_threads)
+        with concurrent.futures.ThreadPoolExecutor(num_download_threads) as pool:
+            # consume the iterator so that exceptions are not silently dropped
+            list(pool.map(_profiled(_download_one), urls))
+    else:
+        list(executor.map(_profiled(_download_one), urls))
+    return downloaded, validated
+
+
+def _remove_stale_partial_downloads(partial_directory, to_mirror):
+    """Remove incomplete downloads of packages that are no longer wanted
+
+    Parameters
+    ----------
+    partial_directory : str
+        The directory that incomplete downloads are kept in
+    to_mirror : set
+        The names of the packages that are going to be downloaded
+    """
+    for f in os.listdir(partial_directory):
+        package_name = f[:f.rindex('.part')]
+        if package_name not in to_mirror:
+            logger.debug('Removing stale partial download %s', f)
+            os.remove(os.path.join(partial_directory, f))
 
 
 def _list_conda_packages(local_dir):
-    """List the conda packages (*.tar.bz2 files) in `local_dir`
+    """List the conda packages (*.tar.bz2 and *.conda files) in `local_dir`
 
     Parameters
     ----------
@@ -437,10 +2222,96 @@ def _list_conda_packages(local_dir):
         List of conda packages in `local_dir`
     """
     contents = os.listdir(local_dir)
-    return fnmatch.filter(contents, "*.tar.bz2")
+    return [f for f in contents if f.endswith(tuple(PACKAGE_FORMATS))]
+
 
+class _ValidationCache(object):
+    """Persistent record of the packages that passed validation
+
+    A package only needs to be validated again if the file changed (its size,
+    mtime or inode differ), the upstream md5 or size of the package
+    changed since it was validated, or it was validated at a lower level than
+    the one asked for now.
+
+    Parameters
+    ----------
+    path : str
+        The path of the sqlite database to keep the records in
+    """
 
-def _validate_packages(package_repodata, package_directory, num_threads=1):
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS validated ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                'inode INTEGER, md5 TEXT, level INTEGER)')
+            columns = [row[1] for row in
+                       self._conn.execute('PRAGMA table_info(validated)')]
+            if 'level' not in columns:
+                # records from before there were validation levels were
+                # validated at the 'hash' level
+                self._conn.execute(
+                    'ALTER TABLE validated ADD COLUMN level INTEGER '
+                    'DEFAULT %s' % VALIDATION_LEVELS.index('hash'))
+
+    @staticmethod
+    def _identity(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def is_valid(self, path, package_metadata, level='hash'):
+        """Whether the package at `path` already passed validation against
+        `package_metadata` at `level` or higher"""
+        try:
+            identity = self._identity(path)
+        except OSError:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT size, mtime_ns, inode, md5, level FROM validated '
+                'WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        if row is None or tuple(row[:3]) != identity:
+            return False
+        expected_size = package_metadata.get('size')
+        return (row[3] == package_metadata.get('md5') and
+                row[4] >= VALIDATION_LEVELS.index(level) and
+                (not expected_size or expected_size == identity[0]))
+
+    def add(self, validated, level='hash'):
+        """Record that packages passed validation
+
+        Parameters
+        ----------
+        validated : iterable
+            Iterable of (path, package_metadata) for each package that
+            passed validation
+        level : {'size', 'hash', 'deep'}, optional
+            The level they were validated at. Defaults to 'hash'.
+        """
+        rows = []
+        for path, package_metadata in validated:
+            try:
+                identity = self._identity(path)
+            except OSError:
+                continue
+            rows.append((os.path.abspath(path),) + identity +
+                        (package_metadata.get('md5'),
+                         VALIDATION_LEVELS.index(level)))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO validated VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+
+    def close(self):
+        self._conn.close()
+
+
+def _validate_packages(package_repodata, package_directory, num_threads=1,
+                       validated=None, validation_cache=None, stats=None,
+                       level='hash', pool=None):
     """Validate local conda packages.
 
     NOTE1: This will remove any packages that are in `package_directory` that
@@ -459,6 +2330,26 @@ def _validate_packages(package_repodata, package_directory, num_threads=1):
         Number of concurrent processes to use. Set to `0` to use a number of
         processes equal to the number of cores in the system. Defaults to `1`
         (i.e. serial package validation).
+    validated : iterable, optional
+        Names of packages in `package_directory` that have already been
+        validated and should not be read again
+    validation_cache : _ValidationCache, optional
+        If provided, packages that passed validation before and did not
+        change since are not validated again. Packages that pass validation
+        are added to it.
+    stats : dict, optional
+        If provided, these counters are added to it:
+        - hits, misses : packages that were (not) found in `validation_cache`
+        - files : packages that were validated
+        - bytes_read : bytes that were read to validate them
+        - seconds : time spent validating them
+    level : {'size', 'hash', 'deep'}, optional
+        How thoroughly to validate the packages. See `VALIDATION_LEVELS`.
+        Defaults to 'hash'.
+    pool : multiprocessing.Pool, optional
+        The validation processes to share with other validations, see
+        `_start_validation_pool`. Defaults to starting `num_threads`
+        processes for this validation alone.
 
     Returns
     -------
@@ -469,47 +2360,196 @@ def _validate_packages(package_repodata, package_directory, num_threads=1):
         reason : str
             The reason why the package is being removed
     """
+    if stats is None:
+        stats = {}
+    for key in ('hits', 'misses', 'files', 'bytes_read', 'seconds'):
+        stats.setdefault(key, 0)
+    start_time = time.monotonic()
+
     # validate local conda packages
-    local_packages = _list_conda_packages(package_directory)
+    local_packages = set(_list_conda_packages(package_directory))
+    local_packages.difference_update(validated or ())
+
+    cached_results = []
+    if validation_cache is not None:
+        for package in sorted(local_packages):
+            package_path = os.path.join(package_directory, package)
+            if (package in package_repodata and
+                    validation_cache.is_valid(package_path,
+                                              package_repodata[package],
+                                              level=level)):
+                cached_results.append((package_path, None))
+        local_packages.difference_update(
+            os.path.basename(path) for path, _ in cached_results)
+        logger.info('%s of %s packages in %s did not change since they were '
+                    'last validated', len(cached_results),
+                    len(cached_results) + len(local_packages),
+                    package_directory)
+        stats['hits'] += len(cached_results)
+        stats['misses'] += len(local_packages)
 
-    # create argument list (necessary because multiprocessing.Pool.map does not
-    # accept additional args to be passed to the mapped function)
     num_packages = len(local_packages)
-    val_func_arg_list = [(package, num, num_packages, package_repodata,
-                          package_directory)
-                         for num, package in enumerate(sorted(local_packages))]
+    tasks = list(enumerate(sorted(local_packages)))
+    # only the metadata of the packages to validate is needed
+    task_repodata = {package: package_repodata[package]
+                     for package in local_packages
+                     if package in package_repodata}
 
     if num_threads == 1 or num_threads is None:
         # Do serial package validation (Takes a long time for large repos)
-        validation_results = map(_validate_or_remove_package,
-                                 val_func_arg_list)
+        validation_results = [
+            _validate_or_remove_package(package, num, num_packages,
+                                        task_repodata.get(package),
+                                        package_directory, level)
+            for num, package in tasks]
     else:
         if num_threads == 0:
             num_threads = os.cpu_count()
             logger.debug('num_threads=0 so it will be replaced by all available '
                          'cores: %s' % num_threads)
-        logger.info('Will use {} threads for package validation.'
-                    ''.format(num_threads))
-        p = multiprocessing.Pool(num_threads)
-        validation_results = p.map(_validate_or_remove_package,
-                                   val_func_arg_list)
-        p.close()
-        p.join()
-
+        own_pool = pool is None
+        if own_pool:
+            logger.info('Will use {} threads for package validation.'
+                        ''.format(num_threads))
+            pool, profile_directory = _start_validation_pool(num_threads)
+        phase = None
+        if _profiler is not None:
+            phase = _current_phase()
+        # a shared pool validates the packages of other directories as well,
+        # so everything about a package goes along with it
+        tasks = [(num, package, task_repodata.get(package), package_directory,
+                  level, num_packages, phase)
+                 for num, package in tasks]
+        # hand out a few packages at a time, but not so many that one worker
+        # ends up with all the big ones
+        chunksize = max(1, min(32, num_packages // (num_threads * 8)))
+        try:
+            validation_results = list(pool.imap_unordered(
+                _validate_in_worker, tasks, chunksize=chunksize))
+        finally:
+            if own_pool:
+                _stop_validation_pool(pool, profile_directory)
+
+    stats['files'] += len(validation_results)
+    stats['bytes_read'] += sum(bytes_read
+                               for _, _, bytes_read in validation_results)
+    validation_results = [(path, reason)
+                          for path, reason, _ in validation_results]
+    if validation_cache is not None:
+        validation_cache.add(
+            ((path, package_repodata[os.path.basename(path)])
+             for path, reason in validation_results if reason is None),
+            level=level)
+        validation_results.extend(cached_results)
+    stats['seconds'] += time.monotonic() - start_time
     return validation_results
 
 
-def _validate_or_remove_package(args):
+def _start_validation_pool(num_threads):
+    """Start `num_threads` processes to validate packages in
+
+    The processes are started right away, so that they are forked before the
+    run starts any threads if they are started first.
+
+    Returns
+    -------
+    pool : multiprocessing.Pool
+    profile_directory : str
+        The directory the workers write their profiles to when they exit.
+        None if the run is not profiled
+    """
+    profile_directory = None
+    if _profiler is not None:
+        profile_directory = tempfile.mkdtemp(dir=_profiler.directory)
+    pool = multiprocessing.Pool(num_threads,
+                                initializer=_init_validation_worker,
+                                initargs=(profile_directory,))
+    return pool, profile_directory
+
+
+def _stop_validation_pool(pool, profile_directory):
+    """Wait for the workers of `pool` to exit and add their profiles to the
+    profiles of the run"""
+    pool.close()
+    pool.join()
+    if profile_directory is not None:
+        for filename in sorted(os.listdir(profile_directory)):
+            phase = filename.split('.')[0]
+            _profiler.add(phase, pstats.Stats(
+                os.path.join(profile_directory, filename)))
+        shutil.rmtree(profile_directory)
+
+
+def _init_validation_worker(profile_directory=None):
+    global _profiler, logger
+    # a spawned worker, e.g. on windows and macOS, does not inherit the
+    # logger that _init_logger set up
+    if logger is None:
+        logger = logging.getLogger('conda_mirror')
+    # a forked worker inherits the profiler of the run, which cannot be
+    # shared with it
+    if _profiler is not None:
+        _profiler.pause()
+        _profiler = None
+    if profile_directory is not None:
+        _profiler = _Profiler(profile_directory)
+        multiprocessing.util.Finalize(
+            None, _dump_worker_profiles, args=(profile_directory,),
+            exitpriority=10)
+
+
+def _dump_worker_profiles(profile_directory):
+    """Write a <phase>.<pid>.pstats file for every phase a validation worker
+    profiled"""
+    for phase, stats in _profiler.stats().items():
+        stats.dump_stats(os.path.join(
+            profile_directory, '%s.%s.pstats' % (phase, os.getpid())))
+
+
+def _validate_in_worker(task):
+    """Validate or remove a package in a validation worker process
+
+    Parameters
+    ----------
+    task : tuple
+        The number of the package in the list of all packages, the name of
+        the package, its metadata, the directory it is in, the validation
+        level, the number of packages and the phase to profile it in
+
+    Returns
+    -------
+    See `_validate_or_remove_package`
+    """
+    (num, package, package_metadata, package_directory, level, num_packages,
+     phase) = task
+    profile = contextlib.ExitStack()
+    if phase is not None and _profiler is not None:
+        profile = _profiler.profile(phase)
+    with profile:
+        return _validate_or_remove_package(package, num, num_packages,
+                                           package_metadata,
+                                           package_directory, level)
+
+
+def _validate_or_remove_package(package, num, num_packages, package_metadata,
+                                package_directory, level='hash'):
     """Validata or remove package.
 
     Parameters
     ----------
-    args : tuple
-        - `args[0]` is `package`.
-        - `args[1]` is the number of the package in the list of all packages.
-        - `args[2]` is the number of all packages.
-        - `args[3]` is `package_repodata`.
-        - `args[4]` is `package_directory`.
+    package : str
+        The name of the package
+    num : int
+        The number of the package in the list of all packages
+    num_packages : int
+        The number of all packages
+    package_metadata : dict
+        The metadata of the package from the upstream repodata. None if it is
+        not in there.
+    package_directory : str
+        The directory the package is in
+    level : {'size', 'hash', 'deep'}, optional
+        How thoroughly to validate the package
 
     Returns
     -------
@@ -517,37 +2557,42 @@ def _validate_or_remove_package(args):
         The full path to the package that is being removed
     reason : str
         The reason why the package is being removed
+    bytes_read : int
+        The number of bytes that were read to validate the package
     """
-    # unpack arg tuple tuple
-    package = args[0]
-    num = args[1]
-    num_packages = args[2]
-    package_repodata = args[3]
-    package_directory = args[4]
-
     # ensure the packages in this directory are in the upstream
     # repodata.json
-    try:
-        package_metadata = package_repodata[package]
-    except KeyError:
+    if package_metadata is None:
         logger.warning("%s is not in the upstream index. Removing...",
                        package)
         reason = "Package is not in the repodata index"
         package_path = os.path.join(package_directory, package)
-        return _remove_package(package_path, reason=reason)
+        return _remove_package(package_path, reason=reason) + (0,)
     # validate the integrity of the package, the size of the package and
     # its hashes
     logger.info('Validating {:4d} of {:4d}: {}.'.format(num + 1, num_packages,
                                                         package))
     package_path = os.path.join(package_directory, package)
-    return _validate(package_path,
-                     md5=package_metadata.get('md5'),
-                     size=package_metadata.get('size'))
+    reason, bytes_read = _check_package(package_path,
+                                        md5=package_metadata.get('md5'),
+                                        size=package_metadata.get('size'),
+                                        sha256=package_metadata.get('sha256'),
+                                        level=level)
+    if reason is not None:
+        return _remove_package(package_path, reason=reason) + (bytes_read,)
+    return package_path, None, bytes_read
 
 
 def main(upstream_channel, target_directory, temp_directory, platform,
          blacklist=None, whitelist=None, num_threads=1, dry_run=False,
-         no_validate_target=False, minimum_free_space=0):
+         no_validate_target=False, minimum_free_space=0,
+         num_download_threads=1, connection_pool_size=None,
+         cache_directory=None, incremental=False, validation_cache=True,
+         existing_validation_level='hash', new_validation_level='hash',
+         compression_threads=1, blob_store=None, download_order='name',
+         max_bandwidth=None, max_connections_per_host=None,
+         metrics_file=None, metrics_port=None, metrics_host='127.0.0.1',
+         profile=None):
     """
 
     Parameters
@@ -563,11 +2608,16 @@ def main(upstream_channel, target_directory, temp_directory, platform,
     temp_directory : str
         The path on disk to an existing and writable directory to temporarily
         store the packages before moving them to the target_directory to
-        apply checks
-    platform : str
-        The platform that you wish to mirror for. Common options are
+        apply checks. If it is on another filesystem than target_directory,
+        a '.conda-mirror/staging' directory in target_directory is used
+        instead, so that moving the packages does not copy them again.
+    platform : str or list of str
+        The platform(s) that you wish to mirror for. Common options are
         'linux-64', 'osx-64', 'win-64' and 'win-32'. Any platform is valid as
-        long as the url resolves.
+        long as the url resolves. Several platforms are mirrored concurrently
+        and share the http connections, the download threads and the free
+        disk space. Platforms that are given more than once are mirrored
+        once.
     blacklist : iterable of tuples, optional
         The values of blacklist should be (key, glob) where key is one of the
         keys in the repodata['packages'] dicts and glob is a thing to match
@@ -579,7 +2629,8 @@ def main(upstream_channel, target_directory, temp_directory, platform,
     num_threads : int, optional
         Number of threads to be used for concurrent validation.  Defaults to
         `num_threads=1` for non-concurrent mode.  To use all available cores,
-        set `num_threads=0`.
+        set `num_threads=0`. The validation processes are shared by all the
+        platforms.
     dry_run : bool, optional
         Defaults to False.
         If True, skip validation and exit after determining what needs to be
@@ -588,17 +2639,117 @@ def main(upstream_channel, target_directory, temp_directory, platform,
         Defaults to False.
         If True, skip validation of files already present in target_directory.
     minimum_free_space : int, optional
-        Stop downloading when free space target_directory or temp_directory reach this threshold.
+        Threshold in megabytes for the free space in target_directory and
+        temp_directory. The packages to download are planned up front in the
+        download order, and those that would bring the free space below the
+        threshold are skipped.
+    num_download_threads : int, optional
+        Number of packages to download concurrently. Defaults to
+        `num_download_threads=1` for serial downloads. Errors downloading one
+        package do not affect the others.
+    connection_pool_size : int, optional
+        Maximum number of connections to keep open to the upstream host.
+        Defaults to `num_download_threads`.
+    cache_directory : str, optional
+        The path on disk to keep state in between runs. The upstream
+        repodata is cached here and only downloaded again when it changes.
+        When neither it nor the blacklist and whitelist changed since the last
+        complete run, only the existing packages are validated, and not even
+        the cached repodata is read if they are not validated either (see
+        `no_validate_target` and `incremental`).
+        Defaults to a '.conda-mirror' directory in `target_directory`.
+    incremental : bool, optional
+        Defaults to False.
+        If True, compare the upstream repodata to the repodata.json written by
+        the previous run and only remove, download and validate the packages
+        that were added, removed or changed (same name, but a different md5
+        or size) upstream. Packages that did not change are neither validated
+        nor looked for on disk.
+    validation_cache : bool, optional
+        Defaults to True.
+        If True, remember which packages passed validation in a sqlite
+        database in `cache_directory`, and only validate them again if the
+        file or its upstream md5 or size changed.
+    existing_validation_level : {'size', 'hash', 'deep'}, optional
+        How thoroughly to validate the packages already in target_directory.
+        See `VALIDATION_LEVELS`. Defaults to 'hash'.
+    new_validation_level : {'size', 'hash', 'deep'}, optional
+        How thoroughly to validate the packages that were downloaded.
+        Packages with a hash in the repodata are hashed while they are
+        downloaded, unless the level is 'size', which only checks their size.
+        Defaults to 'hash'.
+    compression_threads : int, optional
+        Number of threads to compress repodata.json.bz2 with. Defaults to
+        `compression_threads=1`, which writes a single bz2 stream. More
+        threads compress blocks of it in parallel into a multi-stream bz2
+        file, like pbzip2 does.
+    blob_store : str, optional
+        The path on disk to a content-addressed store of all the packages
+        mirrored. Packages are hardlinked into it, and packages that are
+        already in it (by sha256 or md5, e.g. from another platform or
+        channel) are linked from it instead of downloaded, once their hash
+        was checked. Should be on the same filesystem as `target_directory`.
+    download_order : str, optional
+        The order to download packages in. One of `DOWNLOAD_ORDERS`.
+        Defaults to 'name'.
+    max_bandwidth : iterable, optional
+        Limits for the combined download rate of all packages, in bytes per
+        second with an optional K, M or G suffix, e.g. ['10M']. Limits like
+        '09:00-17:00=2M' only apply at that time of day. Defaults to no
+        limit.
+    max_connections_per_host : int, optional
+        The maximum number of concurrent package downloads from one host.
+        Defaults to no limit.
+    metrics_file : str, optional
+        If provided, the metrics of the run are written to this file in the
+        Prometheus text format once it is done, e.g. for the textfile
+        collector of the node exporter.
+    metrics_port : int, optional
+        If provided, the metrics of the run are served over http on this port
+        for as long as it is going on.
+    metrics_host : str, optional
+        The address to serve the metrics on. Defaults to '127.0.0.1', so that
+        they can only be scraped from this host.
+    profile : str, optional
+        If provided, each of the PHASES of the run is profiled with cProfile,
+        including the download threads and validation processes. A
+        <phase>.pstats file for each of them and a profile.collapsed file
+        with the collapsed stacks of all of them, e.g. for flamegraph.pl, are
+        written to this directory.
 
     Returns
     -------
     dict
-        Summary of what was removed and what was downloaded.
+        Summary of what was removed and what was downloaded. If `platform` is
+        a list, a dict of such summaries keyed on platform is returned.
         keys are:
         - validation : set of (path, reason) for each package that was validated.
                        packages where reason=None is a sentinel for a successful validation
         - download : set of (url, download_path) for each package that
                      was downloaded
+        - connections : dict with the number of http connections `opened`
+                        and the number of `requests` served over them
+        - repodata : dict describing how the upstream repodata was fetched.
+                     `not_modified` is True when the cached copy was used
+        - added, removed, changed : set of package names that differ from the
+                                    previous run. Only filled in when
+                                    `incremental` is True
+        - linked : set of package names that were linked from `blob_store`
+                   instead of downloaded
+        - phases : dict with the seconds spent in each of the PHASES
+        - download-stats : dict with the number of `files` and `bytes` that
+                           were downloaded, the `seconds` the downloads took
+                           and a `throughput` histogram of them
+        - skipped : set of package names that were not downloaded because
+                    they do not fit into the free disk space
+        - disk-budget : dict with the number of `planned` and `skipped`
+                        packages and their `planned_bytes` and
+                        `skipped_bytes`
+        - validation-stats : dict with the validation `level`, the number of
+                             validation cache `hits` and `misses`, and
+                             the `files`, `bytes_read`, `seconds` and
+                             `files_per_sec` it took to validate the
+                             'existing' and the 'new' packages
 
     Notes
     -----
@@ -638,77 +2789,745 @@ def main(upstream_channel, target_directory, temp_directory, platform,
     # 7. copy new packages to repo directory
     # 8. download repodata.json and repodata.json.bz2
     # 9. copy new repodata.json and repodata.json.bz2 into the repo
-    summary = {
-        'validating-existing': set(),
-        'validating-new': set(),
-        'downloaded': set(),
-        'blacklisted': set(),
-        'to-mirror': set()
-    }
+    start_time = time.time()
+    # two threads mirroring the same platform would trip over each other
+    platforms = ([platform] if isinstance(platform, str) else
+                 list(collections.OrderedDict.fromkeys(platform)))
+    summaries = {}
+    for platform_name in platforms:
+        summaries[platform_name] = {
+            'validating-existing': set(),
+            'validating-new': set(),
+            'downloaded': set(),
+            'blacklisted': set(),
+            'to-mirror': set(),
+            'connections': {},
+            'repodata': {},
+            'added': set(),
+            'removed': set(),
+            'changed': set(),
+            'linked': set(),
+            'skipped': set(),
+            'disk-budget': {},
+            'phases': {},
+            'download-stats': {},
+            'validation-stats': {
+                'existing': {'level': existing_validation_level},
+                'new': {'level': new_validation_level},
+            },
+        }
     # Implementation:
-    if not os.path.exists(os.path.join(target_directory, platform)):
-        os.makedirs(os.path.join(target_directory, platform))
+    global _profiler
+    for platform_name in platforms:
+        if not os.path.exists(os.path.join(target_directory, platform_name)):
+            os.makedirs(os.path.join(target_directory, platform_name))
+
+    if cache_directory is None:
+        cache_directory = os.path.join(target_directory, '.conda-mirror')
+
+    if profile is not None:
+        os.makedirs(profile, exist_ok=True)
+        _profiler = _Profiler(profile)
+    # everything that is limited for the whole run is shared by the platforms:
+    # the validation processes, which are started before any other thread of
+    # the run, since forking a process with threads can deadlock
+    validation_pool = profile_directory = None
+    if num_threads not in (1, None) and not dry_run:
+        num_threads = num_threads or os.cpu_count()
+        logger.info('Will use %s threads for package validation.',
+                    num_threads)
+        validation_pool, profile_directory = _start_validation_pool(
+            num_threads)
+    # a single session, so that every fetch reuses the same pool of
+    # keep-alive connections, the download threads and the free disk space
+    num_download_threads = max(num_download_threads or 1, 1)
+    session = _make_session(connection_pool_size or num_download_threads)
+    logger.info('Will use %s threads for package download.',
+                num_download_threads)
+    download_executor = concurrent.futures.ThreadPoolExecutor(
+        num_download_threads)
+    disk_budget = _DiskBudget(minimum_free_space * 1024 * 1024)
+    scheduler = _DownloadScheduler(max_bandwidth, max_connections_per_host)
+    blobs = None
+    if blob_store is not None:
+        blobs = _BlobStore(blob_store)
+    cache = None
+    if validation_cache:
+        cache = _ValidationCache(os.path.join(cache_directory,
+                                              'validation.sqlite'))
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = _serve_metrics(
+            metrics_port, lambda: _format_metrics(summaries, start_time),
+            metrics_host)
+    success = False
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(platforms)) as pool:
+            futures = [
+                pool.submit(
+                    _mirror, upstream_channel, target_directory,
+                    temp_directory, platform_name, summaries[platform_name],
+                    session, blacklist=blacklist, whitelist=whitelist,
+                    num_threads=num_threads, dry_run=dry_run,
+                    no_validate_target=no_validate_target,
+                    disk_budget=disk_budget, executor=download_executor,
+                    cache_directory=cache_directory, incremental=incremental,
+                    validation_cache=cache,
+                    existing_validation_level=existing_validation_level,
+                    new_validation_level=new_validation_level,
+                    compression_threads=compression_threads,
+                    blob_store=blobs, scheduler=scheduler,
+                    download_order=download_order,
+                    validation_pool=validation_pool)
+                for platform_name in platforms]
+        # raise the first error, but only after every platform is done
+        for future in futures:
+            future.result()
+        success = True
+    finally:
+        download_executor.shutdown()
+        if validation_pool is not None:
+            if success:
+                _stop_validation_pool(validation_pool, profile_directory)
+            else:
+                validation_pool.terminate()
+        connections = _session_stats(session)
+        logger.info('Opened %(opened)s connections for %(requests)s requests',
+                    connections)
+        for platform_name, summary in summaries.items():
+            summary['connections'].update(connections)
+            for validation_pass, stats in summary['validation-stats'].items():
+                _finish_validation_stats(stats)
+                logger.info('%s: validated %s %s packages at the %s level in '
+                            '%.1fs (%.1f files/sec, %s bytes read, %s cache '
+                            'hits)', platform_name, stats['files'],
+                            validation_pass, stats['level'], stats['seconds'],
+                            stats['files_per_sec'], stats['bytes_read'],
+                            stats['hits'])
+            logger.info('%s: %s', platform_name, ', '.join(
+                '%s %.1fs' % (phase, summary['phases'][phase])
+                for phase in PHASES if phase in summary['phases']))
+        session.close()
+        if cache is not None:
+            cache.close()
+        if metrics_file is not None:
+            _write_metrics(metrics_file, _format_metrics(
+                summaries, start_time, time.time(), success))
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        if _profiler is not None:
+            logger.info('Wrote the profiles to %s',
+                        ', '.join(_profiler.dump()))
+            _profiler = None
+
+    # Also need to make a "noarch" channel or conda gets mad
+    noarch_path = os.path.join(target_directory, 'noarch')
+    if not dry_run and not os.path.exists(noarch_path):
+        os.makedirs(noarch_path, exist_ok=True)
+        noarch_repodata = {'info': {}, 'packages': {}}
+        _write_repodata(noarch_path, noarch_repodata)
+
+    if isinstance(platform, str):
+        return summaries[platform]
+    return summaries
+
+
+def _finish_validation_stats(stats):
+    """Fill in the counters of a validation pass that did not run and the
+    derived `files_per_sec`"""
+    for key in ('hits', 'misses', 'files', 'bytes_read', 'seconds'):
+        stats.setdefault(key, 0)
+    stats['files_per_sec'] = (stats['files'] / stats['seconds']
+                              if stats['seconds'] else 0.)
+
+
+# the phases of a run that are timed by `_phase`, in the order they run in
+PHASES = ['fetch-repodata', 'filter', 'validate-existing', 'download',
+          'validate-new', 'write-repodata', 'publish']
+
+# the stack of phases that are running in each thread, see `_phase`
+_running_phases = threading.local()
+
+# the profiler of the run, only set while `main` runs with `profile`
+_profiler = None
+
+
+@contextlib.contextmanager
+def _phase(summary, name):
+    """Add the time spent in the block to `summary['phases'][name]`
+
+    The time spent in a phase that is nested in another one only counts for
+    the inner one, so that the phases add up to the time of the whole run.
+    The block is profiled as part of the phase if the run is profiled.
+    """
+    stack = _running_phases.__dict__.setdefault('stack', [])
+    # the name of the phase and the time spent in nested phases
+    stack.append([name, 0.])
+    start_time = time.monotonic()
+    profile = contextlib.ExitStack()
+    if _profiler is not None:
+        profile = _profiler.profile(name)
+    try:
+        with profile:
+            yield
+    finally:
+        elapsed = time.monotonic() - start_time
+        _, nested = stack.pop()
+        if stack:
+            stack[-1][1] += elapsed
+        phases = summary['phases']
+        phases[name] = phases.get(name, 0.) + elapsed - nested
+
+
+def _current_phase():
+    """The name of the innermost phase running in this thread, if any"""
+    stack = getattr(_running_phases, 'stack', None)
+    if stack:
+        return stack[-1][0]
+    return None
+
+
+def _profiled(func):
+    """Wrap `func` to be profiled as part of the current phase when it is
+    called from another thread, e.g. by a pool of threads"""
+    profiler = _profiler
+    phase = _current_phase()
+    if profiler is None or phase is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profiler.profile(phase):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class _Profiler(object):
+    """Profile each phase of a run separately with cProfile
+
+    Each thread has a profile per phase it worked on. Only one profile can
+    be enabled in a thread at a time, so a nested phase pauses the profile
+    of the phase it is nested in. The validation worker processes send their
+    profiles back through pstats files in `directory`.
+
+    From Python 3.12 on, cProfile is built on `sys.monitoring`, which allows
+    a single active profiler per process that sees all of its threads. Then
+    there is one profile per phase for the whole process, and while phases
+    run at the same time in different threads, the one that started last
+    gets the time of all of them.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write the profiles to
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # (phase, cProfile.Profile or pstats.Stats) of all threads
+        self._profiles = []
+        self._local = threading.local()
+        self._process_wide = sys.version_info >= (3, 12)
+        # the phases that are profiled process wide, in the order they
+        # started, their profiles and the one that is enabled
+        self._running = []
+        self._process_profiles = {}
+        self._enabled = None
+
+    def profile(self, phase):
+        """Profile the block in the current thread as part of `phase`"""
+        if self._process_wide:
+            return self._profile_process(phase)
+        return self._profile_thread(phase)
+
+    @contextlib.contextmanager
+    def _profile_thread(self, phase):
+        local = self._local
+        if not hasattr(local, 'profiles'):
+            local.profiles = {}
+            local.stack = []
+        profile = local.profiles.get(phase)
+        if profile is None:
+            profile = local.profiles[phase] = cProfile.Profile()
+            with self._lock:
+                self._profiles.append((phase, profile))
+        if local.stack:
+            local.stack[-1].disable()
+        local.stack.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            local.stack.pop()
+            if local.stack:
+                local.stack[-1].enable()
+
+    @contextlib.contextmanager
+    def _profile_process(self, phase):
+        with self._lock:
+            self._running.append(phase)
+            self._enable_latest()
+        try:
+            yield
+        finally:
+            with self._lock:
+                # a phase can run in several threads at once
+                self._running.reverse()
+                self._running.remove(phase)
+                self._running.reverse()
+                self._enable_latest()
+
+    def _enable_latest(self):
+        """Enable the profile of the phase that started last. Must be called
+        with the lock held."""
+        profile = None
+        if self._running:
+            phase = self._running[-1]
+            profile = self._process_profiles.get(phase)
+            if profile is None:
+                profile = self._process_profiles[phase] = cProfile.Profile()
+                self._profiles.append((phase, profile))
+        if profile is not self._enabled:
+            if self._enabled is not None:
+                self._enabled.disable()
+            if profile is not None:
+                profile.enable()
+            self._enabled = profile
+
+    def pause(self):
+        """Stop profiling the current thread for good, e.g. in a worker
+        process that was forked while it was profiled"""
+        # no locking, another thread may have held the lock during the fork
+        if self._enabled is not None:
+            self._enabled.disable()
+            self._enabled = None
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            stack[-1].disable()
+
+    def add(self, phase, stats):
+        """Add the pstats.Stats `stats`, e.g. of another process, to the
+        profile of `phase`"""
+        with self._lock:
+            self._profiles.append((phase, stats))
+
+    def stats(self):
+        """Merge the profiles of all the threads
+
+        Returns
+        -------
+        collections.OrderedDict
+            The pstats.Stats of each phase that has any
+        """
+        stats = collections.OrderedDict()
+        for phase, profile in self._profiles:
+            if isinstance(profile, cProfile.Profile):
+                profile.create_stats()
+            # pstats refuses to add empty profiles
+            if profile.stats:
+                stats.setdefault(phase, pstats.Stats()).add(profile)
+        return stats
+
+    def dump(self):
+        """Write a pstats file for every phase and the collapsed stacks of
+        all of them into `directory`
+
+        Returns
+        -------
+        list
+            The paths of the files that were written
+        """
+        paths = []
+        stacks = collections.Counter()
+        for phase, phase_stats in self.stats().items():
+            path = os.path.join(self.directory, phase + '.pstats')
+            phase_stats.dump_stats(path)
+            paths.append(path)
+            stacks.update(_collapse_stats(phase_stats, phase))
+        path = os.path.join(self.directory, 'profile.collapsed')
+        with open(path, 'w') as f:
+            for stack, microseconds in sorted(stacks.items()):
+                if microseconds:
+                    f.write('%s %d\n' % (stack, microseconds))
+        paths.append(path)
+        return paths
+
+
+def _frame_name(func):
+    """Name a function of a pstats.Stats for a collapsed stack"""
+    filename, line, name = func
+    if filename == '~':
+        # built-in function
+        label = name
+    else:
+        label = '%s (%s:%d)' % (name, os.path.basename(filename), line)
+    return label.replace(';', ',')
+
+
+def _collapse_stats(stats, root, min_seconds=1e-5, max_depth=100):
+    """Turn the call graph of `stats` into collapsed stacks, the format of
+    the stackcollapse scripts of FlameGraph
+
+    cProfile only records which function called which, not whole stacks, so
+    the time of a function is split among its callers in proportion to the
+    time it spent being called by each of them. Stacks that took less than
+    `min_seconds` are left out.
 
-    info, packages = get_repodata(upstream_channel, platform)
+    Parameters
+    ----------
+    stats : pstats.Stats
+        The profile to collapse
+    root : str
+        The name of the frame to put at the bottom of every stack
+
+    Returns
+    -------
+    collections.Counter
+        The microseconds spent in each stack, keyed on the ';' separated
+        frames of the stack
+    """
+    callees = collections.defaultdict(dict)
+    roots = []
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            callees[caller][func] = caller_stats[3]
+        if not any(caller in stats.stats for caller in callers):
+            roots.append(func)
+    stacks = collections.Counter()
+
+    def walk(func, frames, path, fraction):
+        _, _, inline_time, cumulative_time, _ = stats.stats[func]
+        frames = frames + [_frame_name(func)]
+        stacks[';'.join(frames)] += int(inline_time * fraction * 1e6)
+        if len(frames) > max_depth:
+            return
+        path = path | {func}
+        for callee, callee_time in callees[func].items():
+            total_time = stats.stats[callee][3]
+            callee_time *= fraction
+            if (callee in path or callee_time < min_seconds or
+                    not total_time):
+                continue
+            walk(callee, frames, path, min(callee_time / total_time, 1.))
+
+    for func in roots:
+        if stats.stats[func][3] >= min_seconds:
+            walk(func, [root], frozenset(), 1.)
+    return stacks
+
+
+def _format_metric_value(value):
+    if isinstance(value, int):
+        return str(int(value))
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_metrics(summaries, start_time, end_time=None, success=None):
+    """Format the summaries of a run in the Prometheus text format
+
+    Parameters
+    ----------
+    summaries : dict
+        The summaries of `main`, keyed on platform. They can still be filled
+        in by a run that is going on.
+    start_time : float
+        The time the run started at, in seconds since the epoch
+    end_time : float, optional
+        The time the run finished at. Defaults to a run that is going on.
+    success : bool, optional
+        Whether the run finished without errors
+
+    Returns
+    -------
+    str
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP conda_mirror_%s %s' % (name, help_text))
+        lines.append('# TYPE conda_mirror_%s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            labels = ','.join(
+                '%s="%s"' % (label, str(label_value).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+                for label, label_value in labels)
+            lines.append('conda_mirror_%s%s%s %s' % (
+                name, suffix, '{%s}' % labels if labels else '',
+                _format_metric_value(value)))
+
+    platforms = sorted(summaries)
+    metric('run_start_time_seconds', 'gauge',
+           'The time the run started at, in seconds since the epoch',
+           [('', (), start_time)])
+    metric('run_duration_seconds', 'gauge', 'The duration of the run',
+           [('', (), (end_time or time.time()) - start_time)])
+    if success is not None:
+        metric('run_success', 'gauge',
+               'Whether the run finished without errors',
+               [('', (), success)])
+    metric('phase_duration_seconds', 'gauge',
+           'The time spent in each phase of the run',
+           [('', (('platform', platform), ('phase', phase)),
+             summaries[platform]['phases'].get(phase, 0))
+            for platform in platforms for phase in PHASES])
+    samples = []
+    for platform in platforms:
+        summary = summaries[platform]
+        removed = sum(
+            1 for _, reason in itertools.chain(
+                list(summary['validating-existing']),
+                list(summary['validating-new']))
+            if reason is not None)
+        for state, count in (('to-mirror', len(summary['to-mirror'])),
+                             ('downloaded', len(summary['downloaded'])),
+                             ('linked', len(summary['linked'])),
+                             ('skipped', len(summary['skipped'])),
+                             ('blacklisted', len(summary['blacklisted'])),
+                             ('removed', removed)):
+            samples.append(('', (('platform', platform), ('state', state)),
+                            count))
+    metric('packages', 'gauge',
+           'The number of packages in each state. Removed packages failed '
+           'validation', samples)
+    metric('repodata_bytes', 'gauge',
+           'The size of the upstream repodata as it was transferred and '
+           'decoded',
+           [('', (('platform', platform), ('stage', stage)),
+             summaries[platform]['repodata'].get(stage + '_bytes', 0))
+            for platform in platforms for stage in ('transferred', 'decoded')])
+    metric('disk_budget_bytes', 'gauge',
+           'The size of the packages that were planned to be downloaded and '
+           'that were skipped because they did not fit on disk',
+           [('', (('platform', platform), ('state', state)),
+             summaries[platform]['disk-budget'].get(state + '_bytes', 0))
+            for platform in platforms for state in ('planned', 'skipped')])
+    metric('downloaded_bytes', 'gauge', 'The size of the downloaded packages',
+           [('', (('platform', platform),),
+             summaries[platform]['download-stats'].get('bytes', 0))
+            for platform in platforms])
+    metric('download_seconds', 'gauge',
+           'The time spent downloading packages, summed over all downloads',
+           [('', (('platform', platform),),
+             summaries[platform]['download-stats'].get('seconds', 0))
+            for platform in platforms])
+    samples = []
+    for platform in platforms:
+        histogram = summaries[platform]['download-stats'].get(
+            'throughput', {'buckets': [0] * len(THROUGHPUT_BUCKETS),
+                           'sum': 0.})
+        buckets = list(histogram['buckets'])
+        for bucket, count in zip(THROUGHPUT_BUCKETS,
+                                 itertools.accumulate(buckets)):
+            samples.append(('_bucket', (('platform', platform),
+                                        ('le', _format_metric_value(float(bucket)))),
+                            count))
+        samples.append(('_sum', (('platform', platform),), histogram['sum']))
+        samples.append(('_count', (('platform', platform),), sum(buckets)))
+    metric('download_throughput_bytes_per_second', 'histogram',
+           'The throughput of the package downloads', samples)
+    for name, key, help_text in (
+            ('validation_files', 'files', 'The number of validated packages'),
+            ('validation_bytes_read', 'bytes_read',
+             'The bytes read to validate packages'),
+            ('validation_seconds', 'seconds',
+             'The time spent validating packages')):
+        metric(name, 'gauge', help_text,
+               [('', (('platform', platform), ('pass', validation_pass)),
+                 stats.get(key, 0))
+                for platform in platforms
+                for validation_pass, stats in sorted(
+                    summaries[platform]['validation-stats'].items())])
+    samples = []
+    cache_samples = []
+    for platform in platforms:
+        for validation_pass, stats in sorted(
+                summaries[platform]['validation-stats'].items()):
+            labels = (('platform', platform), ('pass', validation_pass))
+            files, seconds = stats.get('files', 0), stats.get('seconds', 0)
+            samples.append(('', labels, files / seconds if seconds else 0))
+            lookups = stats.get('hits', 0) + stats.get('misses', 0)
+            if lookups:
+                cache_samples.append(('', labels, stats['hits'] / lookups))
+    metric('validation_files_per_second', 'gauge',
+           'The number of packages validated per second', samples)
+    metric('validation_cache_hit_ratio', 'gauge',
+           'The share of packages whose validation result was cached',
+           cache_samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _write_metrics(path, metrics):
+    """Replace the file at `path` with `metrics` at once, so that the
+    textfile collector of the Prometheus node exporter never reads half of
+    it"""
+    with open(path + '.tmp', 'w') as f:
+        f.write(metrics)
+    os.replace(path + '.tmp', path)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the metrics of the `server.get_metrics` callable"""
+
+    def do_GET(self):
+        body = self.server.get_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('metrics request: ' + format, *args)
+
+
+def _serve_metrics(port, get_metrics, host='127.0.0.1'):
+    """Serve the output of `get_metrics` over http on `host`:`port` in a
+    background thread, until the returned server is shut down"""
+    server = http.server.HTTPServer((host, port), _MetricsHandler)
+    server.get_metrics = get_metrics
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info('Serving metrics on %s:%s', host, server.server_address[1])
+    return server
+
+
+def _mirror(upstream_channel, target_directory, temp_directory, platform,
+            summary, session, blacklist=None, whitelist=None, num_threads=1,
+            dry_run=False, no_validate_target=False, disk_budget=None,
+            executor=None, cache_directory=None, incremental=False,
+            validation_cache=None, existing_validation_level='hash',
+            new_validation_level='hash', compression_threads=1,
+            blob_store=None, scheduler=None, download_order='name',
+            validation_pool=None):
+    """Mirror one platform of `upstream_channel` and fill in its `summary`.
+
+    See `main` for details
+    """
+    if disk_budget is None:
+        disk_budget = _DiskBudget()
+    with _phase(summary, 'fetch-repodata'):
+        repodata_chunks = _open_repodata(upstream_channel, platform, session,
+                                         cache_directory, summary['repodata'])
     local_directory = os.path.join(target_directory, platform)
 
+    # 0. short-circuit if nothing changed since the last complete run
+    state_path = _mirror_state_path(cache_directory, local_directory)
+    state = {'fingerprint': _mirror_fingerprint(summary['repodata'],
+                                                blacklist, whitelist)}
+    is_current = (summary['repodata']['not_modified'] and not dry_run and
+                  _is_mirror_current(state_path, state, local_directory))
+    if is_current and (no_validate_target or incremental):
+        # the packages are not even needed for validating the existing ones,
+        # so the repodata is not read at all
+        logger.info('Upstream repodata and filters did not change since the '
+                    'last run. %s is up to date. Nothing to do.',
+                    local_directory)
+        repodata_chunks.close()
+        return summary
+
+    # 2. figure out blacklisted packages
+    # 3. un-blacklist packages that are actually whitelisted
+    # both happen while the repodata is parsed, so that the blacklisted
+    # packages are never kept in memory
+    with _phase(summary, 'fetch-repodata'):
+        info, packages = _parse_repodata(
+            repodata_chunks, platform, blacklist=blacklist,
+            whitelist=whitelist, blacklisted=summary['blacklisted'])
+
+    validated_existing = False
+    if is_current:
+        logger.info('Upstream repodata and filters did not change since the '
+                    'last run.')
+        with _phase(summary, 'validate-existing'):
+            summary['validating-existing'].update(
+                _validate_packages(
+                    packages, local_directory, num_threads,
+                    validation_cache=validation_cache,
+                    stats=summary['validation-stats']['existing'],
+                    level=existing_validation_level,
+                    pool=validation_pool))
+        validated_existing = True
+        if all(reason is None
+               for _, reason in summary['validating-existing']):
+            logger.info('%s is up to date. Nothing to do.', local_directory)
+            return summary
+        logger.info('Some packages failed validation. Syncing %s.',
+                    local_directory)
+
     # 1. validate local repo
     # validating all packages is taking many hours.
     # _validate_packages(repodata=repodata,
     #                    package_directory=local_directory,
     #                    num_threads=num_threads)
 
-    # 2. figure out blacklisted packages
-    blacklist_packages = {}
-    whitelist_packages = {}
-    # match blacklist conditions
-    if blacklist:
-        blacklist_packages = {}
-        for blist in blacklist:
-            logger.debug('blacklist item: %s', blist)
-            matched_packages = _match(packages, blist)
-            logger.debug(pformat(list(matched_packages.keys())))
-            blacklist_packages.update(matched_packages)
-
-    # 3. un-blacklist packages that are actually whitelisted
-    # match whitelist on blacklist
-    if whitelist:
-        whitelist_packages = {}
-        for wlist in whitelist:
-            matched_packages = _match(packages, wlist)
-            whitelist_packages.update(matched_packages)
-    # make final mirror list of not-blacklist + whitelist
-    true_blacklist = set(blacklist_packages.keys()) - set(
-        whitelist_packages.keys())
-    summary['blacklisted'].update(true_blacklist)
-
     logger.info("BLACKLISTED PACKAGES")
-    logger.info(pformat(true_blacklist))
-
-    # Get a list of all packages in the local mirror
-    if dry_run:
-        local_packages = _list_conda_packages(local_directory)
-        packages_slated_for_removal = [
-            pkg_name for pkg_name in local_packages if pkg_name in summary['blacklisted']
-        ]
-        logger.info("PACKAGES TO BE REMOVED")
-        logger.info(pformat(packages_slated_for_removal))
-
-    possible_packages_to_mirror = set(packages.keys()) - true_blacklist
-
-    # 4. Validate all local packages
-    # construct the desired package repodata
-    desired_repodata = {pkgname: packages[pkgname]
-                        for pkgname in possible_packages_to_mirror}
-    if not (dry_run or no_validate_target):
-        # Only validate if we're not doing a dry-run
-        validation_results = _validate_packages(desired_repodata, local_directory, num_threads)
-        summary['validating-existing'].update(validation_results)
-    # 5. figure out final list of packages to mirror
-    # do the set difference of what is local and what is in the final
-    # mirror list
-    local_packages = _list_conda_packages(local_directory)
-    to_mirror = possible_packages_to_mirror - set(local_packages)
+    logger.info(pformat(summary['blacklisted']))
+
+    # validating the existing packages is its own phase, even though it
+    # happens while the packages to mirror are figured out
+    with _phase(summary, 'filter'):
+        # Get a list of all packages in the local mirror
+        if dry_run:
+            local_packages = _list_conda_packages(local_directory)
+            packages_slated_for_removal = [
+                pkg_name for pkg_name in local_packages
+                if pkg_name in summary['blacklisted']
+            ]
+            logger.info("PACKAGES TO BE REMOVED")
+            logger.info(pformat(packages_slated_for_removal))
+
+        possible_packages_to_mirror = set(packages.keys())
+
+        # 4. Validate all local packages
+        # construct the desired package repodata
+        desired_repodata = packages
+        baseline = None
+        if incremental:
+            baseline = _read_local_repodata(local_directory)
+            if baseline is None:
+                logger.info('No repodata.json from a previous run in %s. '
+                            'Doing a full sync.', local_directory)
+        if baseline is not None:
+            # only work on what changed upstream since the last run
+            added, removed, changed = _diff_repodata(baseline,
+                                                     desired_repodata)
+            summary['added'].update(added)
+            summary['removed'].update(removed)
+            summary['changed'].update(changed)
+            logger.info('%s packages were added, %s removed and %s changed '
+                        'upstream since the last run', len(added),
+                        len(removed), len(changed))
+            if not dry_run:
+                for package in sorted(removed | changed):
+                    package_path = os.path.join(local_directory, package)
+                    if os.path.exists(package_path):
+                        summary['validating-existing'].add(_remove_package(
+                            package_path,
+                            reason="Package was removed or changed upstream"))
+            local_packages = sorted(set(baseline) - removed - changed)
+            to_mirror = added | changed
+        else:
+            if not (dry_run or no_validate_target or validated_existing):
+                # Only validate if we're not doing a dry-run
+                with _phase(summary, 'validate-existing'):
+                    validation_results = _validate_packages(
+                        desired_repodata, local_directory, num_threads,
+                        validation_cache=validation_cache,
+                        stats=summary['validation-stats']['existing'],
+                        level=existing_validation_level,
+                        pool=validation_pool)
+                summary['validating-existing'].update(validation_results)
+            # 5. figure out final list of packages to mirror
+            # do the set difference of what is local and what is in the final
+            # mirror list
+            local_packages = _list_conda_packages(local_directory)
+            to_mirror = possible_packages_to_mirror - set(local_packages)
     logger.info('PACKAGES TO MIRROR')
     logger.info(pformat(sorted(to_mirror)))
     summary['to-mirror'].update(to_mirror)
@@ -721,41 +3540,85 @@ def main(upstream_channel, target_directory, temp_directory, platform,
     # b. validate contents of temp file
     # c. move to local repo
     # mirror all new packages
-    total_bytes = 0
-    minimum_free_space_kb = (minimum_free_space * 1024 * 1024)
     download_url, channel = _maybe_split_channel(upstream_channel)
-    with tempfile.TemporaryDirectory(dir=temp_directory) as download_dir:
+    staging_directory = _staging_directory(temp_directory, target_directory)
+    # incomplete downloads are kept outside of the throwaway download_dir so
+    # that the next run can resume them
+    partial_directory = os.path.join(staging_directory, 'conda-mirror-partial',
+                                     channel, platform)
+    os.makedirs(partial_directory, exist_ok=True)
+    _remove_stale_partial_downloads(partial_directory, to_mirror)
+    # whatever is left of the reserved disk space is given back in the end,
+    # also for the packages that failed to download
+    with tempfile.TemporaryDirectory(dir=staging_directory) as download_dir, \
+            disk_budget.reserving(local_directory):
         logger.info('downloading to the tempdir %s', download_dir)
-        for package_name in sorted(to_mirror):
-            url = download_url.format(
-                channel=channel,
-                platform=platform,
-                file_name=package_name)
-            try:
-                # make sure we have enough free disk space in the temp folder to meet threshold
-                if shutil.disk_usage(download_dir).free < minimum_free_space_kb:
-                    logger.error('Disk space below threshold in %s. Aborting download.',
-                                 download_dir)
-                    break
-
-                # download package
-                total_bytes += _download(url, download_dir)
-
-                # make sure we have enough free disk space in the target folder to meet threshold
-                # while also being able to fit the packages we have already downloaded
-                if (shutil.disk_usage(local_directory).free - total_bytes) < minimum_free_space_kb:
-                    logger.error('Disk space below threshold in %s. Aborting download',
-                                 local_directory)
-                    break
-
-                summary['downloaded'].add((url, download_dir))
-            except Exception as ex:
-                logger.exception('Unexpected error: %s. Aborting download.', ex)
-                break
+        # packages that were mirrored before, maybe for another platform or
+        # channel, do not need to be downloaded again
+        linked = set()
+        if blob_store is not None:
+            with _phase(summary, 'download'):
+                for package_name in sorted(to_mirror):
+                    if blob_store.link(
+                            packages[package_name],
+                            os.path.join(download_dir, package_name)):
+                        linked.add(package_name)
+            logger.info('Linked %s packages from the blob store %s',
+                        len(linked), blob_store.path)
+            summary['linked'].update(linked)
+        # decide up front which packages fit on disk, so that running out of
+        # space does not stop the run halfway through
+        with _phase(summary, 'filter'):
+            planned, skipped = disk_budget.plan(
+                _order_downloads(to_mirror - linked, packages, download_order,
+                                 whitelist),
+                packages, download_dir, local_directory)
+        summary['skipped'].update(skipped)
+        budget = summary['disk-budget']
+        budget['planned'] = len(planned)
+        budget['planned_bytes'] = sum(packages[package_name].get('size') or 0
+                                      for package_name in planned)
+        budget['skipped'] = len(skipped)
+        budget['skipped_bytes'] = sum(packages[package_name].get('size') or 0
+                                      for package_name in skipped)
+        logger.info('Planned %(planned)s packages (%(planned_bytes)s bytes) '
+                    'to download', budget)
+        if skipped:
+            logger.error('Skipping %(skipped)s packages (%(skipped_bytes)s '
+                         'bytes) that do not fit into the free disk space',
+                         budget)
+            logger.info(pformat(skipped))
+        urls = [download_url.format(channel=channel, platform=platform,
+                                    file_name=package_name)
+                for package_name in planned]
+        with _phase(summary, 'download'):
+            downloaded, validated = _download_packages(
+                urls, download_dir, session=session,
+                partial_directory=partial_directory,
+                package_repodata=packages, executor=executor,
+                scheduler=scheduler, stats=summary['download-stats'],
+                disk_budget=disk_budget, local_directory=local_directory,
+                level=new_validation_level)
+        summary['downloaded'].update(downloaded)
+        summary['validating-new'].update(validated)
 
         # validate all packages in the download directory
-        validation_results = _validate_packages(packages, download_dir,
-                                                num_threads=num_threads)
+        # packages that were hashed while they were downloaded do not need
+        # to be read back in again, unless they need a deep validation
+        # the same goes for packages from the blob store, which were hashed
+        # when they were linked
+        already_validated = {os.path.basename(path) for path, _ in validated}
+        already_validated.update(linked)
+        if new_validation_level == 'deep':
+            already_validated = {
+                os.path.basename(path) for path, reason in validated
+                if reason is not None}
+        with _phase(summary, 'validate-new'):
+            validation_results = _validate_packages(
+                packages, download_dir, num_threads=num_threads,
+                validated=already_validated,
+                stats=summary['validation-stats']['new'],
+                level=new_validation_level, pool=validation_pool)
         summary['validating-new'].update(validation_results)
         logger.debug('Newly downloaded files at %s are %s',
                      download_dir,
@@ -765,55 +3628,290 @@ def main(upstream_channel, target_directory, temp_directory, platform,
         # packages we don't want
         repodata = {'info': info, 'packages': packages}
 
-        # compute the packages that we have locally
-        packages_we_have = set(local_packages +
-                               _list_conda_packages(download_dir))
-        # remake the packages dictionary with only the packages we have
-        # locally
-        repodata['packages'] = {
-            name: info for name, info in repodata['packages'].items()
-            if name in packages_we_have}
-        _write_repodata(download_dir, repodata)
-
-        # move new conda packages
-        for f in _list_conda_packages(download_dir):
-            old_path = os.path.join(download_dir, f)
-            new_path = os.path.join(local_directory, f)
-            logger.info("moving %s to %s", old_path, new_path)
-            shutil.move(old_path, new_path)
-
-        for f in ('repodata.json', 'repodata.json.bz2'):
-            download_path = os.path.join(download_dir, f)
-            move_path = os.path.join(local_directory, f)
-            shutil.move(download_path, move_path)
-
-    # Also need to make a "noarch" channel or conda gets mad
-    noarch_path = os.path.join(target_directory, 'noarch')
-    if not os.path.exists(noarch_path):
-        os.makedirs(noarch_path, exist_ok=True)
-        noarch_repodata = {'info': {}, 'packages': {}}
-        _write_repodata(noarch_path, noarch_repodata)
+        with _phase(summary, 'write-repodata'):
+            # compute the packages that we have locally
+            packages_we_have = set(local_packages +
+                                   _list_conda_packages(download_dir))
+            # remake the packages dictionary with only the packages we have
+            # locally
+            repodata['packages'] = {
+                name: info for name, info in repodata['packages'].items()
+                if name in packages_we_have}
+            _write_repodata(download_dir, repodata, compression_threads)
+
+        with _phase(summary, 'publish'):
+            # move new conda packages
+            new_packages = _list_conda_packages(download_dir)
+            for f in new_packages:
+                old_path = os.path.join(download_dir, f)
+                new_path = os.path.join(local_directory, f)
+                logger.info("moving %s to %s", old_path, new_path)
+                _move(old_path, new_path)
+                disk_budget.release(local_directory, f)
+                if blob_store is not None:
+                    blob_store.add(packages[f], new_path)
+            # the new packages just passed validation
+            if validation_cache is not None:
+                validation_cache.add(((os.path.join(local_directory, f),
+                                       packages[f]) for f in new_packages),
+                                     level=new_validation_level)
+
+            for f in ('repodata.json', 'repodata.json.bz2'):
+                download_path = os.path.join(download_dir, f)
+                move_path = os.path.join(local_directory, f)
+                _move(download_path, move_path)
+
+    # remember the state of a complete run so the next one can skip the work
+    # if nothing changed. Incomplete runs need to be retried.
+    if possible_packages_to_mirror <= packages_we_have:
+        _write_mirror_state(state_path, state, local_directory)
+    elif os.path.exists(state_path):
+        os.remove(state_path)
 
     return summary
 
 
-def _write_repodata(package_dir, repodata_dict):
-    data = json.dumps(repodata_dict, indent=2, sort_keys=True)
-    # strip trailing whitespace
-    data = '\n'.join(line.rstrip() for line in data.splitlines())
-    # make sure we have newline at the end
-    if not data.endswith('\n'):
-        data += '\n'
+def _read_local_repodata(local_directory):
+    """Read the packages from the repodata.json in `local_directory`
+
+    Returns
+    -------
+    dict
+        The packages section of repodata.json. None if there is no (readable)
+        repodata.json
+    """
+    try:
+        with open(os.path.join(local_directory, 'repodata.json'), 'rb') as f:
+            repodata = json.loads(f.read().decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+    packages = repodata.get('packages', {})
+    packages.update(repodata.get('packages.conda', {}))
+    return packages
+
+
+def _diff_repodata(old_packages, new_packages):
+    """Compare two versions of the packages section of repodata.json
+
+    Parameters
+    ----------
+    old_packages, new_packages : dict
+        The packages sections to compare
+
+    Returns
+    -------
+    added : set
+        Names of the packages that are only in `new_packages`
+    removed : set
+        Names of the packages that are only in `old_packages`
+    changed : set
+        Names of the packages that are in both, but whose md5 or size differ
+    """
+    added = set(new_packages) - set(old_packages)
+    removed = set(old_packages) - set(new_packages)
+    changed = set()
+    for name in set(old_packages) & set(new_packages):
+        old, new = old_packages[name], new_packages[name]
+        if (old.get('md5') != new.get('md5') or
+                old.get('size') != new.get('size')):
+            changed.add(name)
+    return added, removed, changed
+
+
+def _mirror_state_path(cache_directory, local_directory):
+    """The path of the file that records the last complete run into
+    `local_directory`"""
+    key = hashlib.md5(os.path.abspath(local_directory).encode('utf-8'))
+    return os.path.join(cache_directory, 'state', key.hexdigest()[:8] + '.json')
+
 
-    with open(os.path.join(package_dir,
-                           'repodata.json'), 'w') as fo:
-        fo.write(data)
+def _mirror_fingerprint(repodata_stats, blacklist, whitelist):
+    """Fingerprint the inputs that decide which packages should be mirrored
+
+    Parameters
+    ----------
+    repodata_stats : dict
+        The stats filled in by `get_repodata`
+    blacklist, whitelist : iterable of dicts
+        See `main`
+
+    Returns
+    -------
+    str
+        None if the upstream repodata has neither an ETag nor a Last-Modified
+        header, since then there is no way to tell whether it changed.
+    """
+    if not (repodata_stats.get('etag') or repodata_stats.get('last_modified')):
+        return None
+    inputs = {'url': repodata_stats.get('url'),
+              'etag': repodata_stats.get('etag'),
+              'last_modified': repodata_stats.get('last_modified'),
+              'blacklist': blacklist,
+              'whitelist': whitelist}
+    return hashlib.md5(json.dumps(inputs, sort_keys=True, default=str)
+                       .encode('utf-8')).hexdigest()
+
+
+def _local_packages_fingerprint(local_directory):
+    """Fingerprint the names of the conda packages in `local_directory`"""
+    local_packages = sorted(_list_conda_packages(local_directory))
+    return hashlib.md5('\n'.join(local_packages).encode('utf-8')).hexdigest()
+
+
+def _is_mirror_current(state_path, state, local_directory):
+    """Check whether the last complete run had the same inputs as this one
+    and nothing was added to or removed from `local_directory` since"""
+    if state['fingerprint'] is None:
+        return False
+    try:
+        with open(state_path) as f:
+            previous_state = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (previous_state.get('fingerprint') == state['fingerprint'] and
+            previous_state.get('packages') ==
+            _local_packages_fingerprint(local_directory))
+
+
+def _write_mirror_state(state_path, state, local_directory):
+    """Record the inputs and outcome of a complete run into
+    `local_directory`"""
+    if state['fingerprint'] is None:
+        return
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    state = dict(state, packages=_local_packages_fingerprint(local_directory))
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+
+
+def _iter_repodata_json(repodata_dict, block_size=256 * 1024):
+    """Serialize `repodata_dict` like ``json.dumps(repodata_dict, indent=2,
+    sort_keys=True)`` does, in blocks of about `block_size` bytes
+
+    Package records are turned into dicts one at a time, as they are
+    serialized.
+    """
+    encoder = json.JSONEncoder(indent=2, sort_keys=True, default=dict)
+    block = []
+    size = 0
+    for chunk in itertools.chain(encoder.iterencode(repodata_dict), ['\n']):
+        block.append(chunk)
+        size += len(chunk)
+        if size >= block_size:
+            yield ''.join(block).encode('utf-8')
+            block = []
+            size = 0
+    yield ''.join(block).encode('utf-8')
+
+
+class _Bz2Writer(object):
+    """Compress the data written to it into the bz2 file at `path` in the
+    background
+
+    bz2 releases the GIL while it compresses, so the data is compressed by
+    other threads while the caller keeps producing it.
+
+    Parameters
+    ----------
+    path : str
+        The path of the .bz2 file to write
+    num_threads : int, optional
+        With 1 thread (the default), the data is compressed into a single bz2
+        stream. With more, it is split into blocks of `block_size` bytes that
+        are compressed in parallel and written as consecutive bz2 streams,
+        like pbzip2 does. Python's bz2 module and conda read those as one
+        file.
+    block_size : int, optional
+        The number of bytes to hand to the compressor at a time
+    """
+
+    def __init__(self, path, num_threads=1, block_size=4 * 1024 * 1024):
+        self._num_threads = max(num_threads or 1, 1)
+        self._block_size = block_size
+        self._compressor = None
+        if self._num_threads == 1:
+            self._compressor = bz2.BZ2Compressor()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            self._num_threads)
+        self._pending = collections.deque()
+        self._block = []
+        self._size = 0
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        self._block.append(data)
+        self._size += len(data)
+        if self._size >= self._block_size:
+            self._submit()
+
+    def _submit(self):
+        block = b''.join(self._block)
+        self._block = []
+        self._size = 0
+        if self._compressor is not None:
+            # a single compressor thread runs the submitted blocks in order
+            future = self._executor.submit(
+                _profiled(self._compressor.compress), block)
+        else:
+            future = self._executor.submit(_profiled(bz2.compress), block)
+        self._pending.append(future)
+        # do not buffer more than a couple of blocks per thread
+        while len(self._pending) > 2 * self._num_threads:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        try:
+            if self._block:
+                self._submit()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            if self._compressor is not None:
+                self._file.write(self._compressor.flush())
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _write_repodata(package_dir, repodata_dict, compression_threads=1):
+    """Write repodata.json and repodata.json.bz2 into `package_dir`
+
+    The json is written and compressed as it is serialized, without ever
+    holding all of it in memory.
+
+    Parameters
+    ----------
+    package_dir : str
+        The directory to write to
+    repodata_dict : dict
+        The 'info' and 'packages' of the repodata. The packages are split
+        into the PACKAGE_FORMATS sections by extension.
+    compression_threads : int, optional
+        The number of threads to compress repodata.json.bz2 with. See
+        `_Bz2Writer`.
+    """
+    # .conda packages go into their own section of repodata.json
+    repodata_dict = dict(repodata_dict)
+    packages = repodata_dict.pop('packages', {})
+    for extension, section in PACKAGE_FORMATS.items():
+        section_packages = {name: info for name, info in packages.items()
+                            if name.endswith(extension)}
+        if section_packages or section == 'packages':
+            repodata_dict[section] = section_packages
 
     # compress repodata.json into the bz2 format. some conda commands still
     # need it
-    bz2_path = os.path.join(package_dir, 'repodata.json.bz2')
-    with open(bz2_path, 'wb') as fo:
-        fo.write(bz2.compress(data.encode('utf-8')))
+    with open(os.path.join(package_dir, 'repodata.json'), 'wb') as fo, \
+            _Bz2Writer(os.path.join(package_dir, 'repodata.json.bz2'),
+                       compression_threads) as bz2_fo:
+        for block in _iter_repodata_json(repodata_dict):
+            fo.write(block)
+            bz2_fo.write(block)
 
 
 if __name__ == "__main__":
@@ -25,6 +25,10 @@ setup(
         'requests',
         'pyyaml',
     ],
+    extras_require={
+        # fetch the smaller repodata.json.zst when the channel has it
+        'zstd': ['zstandard'],
+    },
     entry_points={
         "console_scripts": [
             'conda-mirror = conda_mirror.conda_mirror:cli'
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+"""Offline end to end benchmark of conda-mirror against synthetic channels
+
+A channel with the given number of records in its repodata.json and a tiny,
+but valid, .tar.bz2 package for each of them is generated once and served
+from a local http server in another process. `conda_mirror.main` mirrors it
+into an empty target directory without validation, which only checks the
+sizes of the packages, and with validation, which hashes them. Then it syncs
+the complete mirror again, which validates all the existing packages.
+
+Each run happens in a fresh process, so that the peak RSS that is reported
+is its own. The wall time and the time and throughput of each phase of the
+run are reported as well.
+
+    $ python test/benchmark_mirror.py --records 10000 100000 1000000
+
+The channels are kept in --directory, so that they only need to be generated
+once. A channel with 1M records takes several minutes to generate and about
+1GB of disk space for its packages and repodata.
+"""
+import argparse
+import bz2
+import hashlib
+import http.server
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socketserver
+import sys
+import tarfile
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
+from conda_mirror import conda_mirror
+
+# the runs of each benchmark: the name of the run and the arguments for main
+RUNS = [
+    ('no-validation', {'no_validate_target': True,
+                       'new_validation_level': 'size',
+                       'validation_cache': False}),
+    ('validation', {}),
+    ('resync', {}),
+]
+
+
+def _make_package(record):
+    """Make a tiny .tar.bz2 package with the info/index.json of `record`"""
+    data = json.dumps(record, sort_keys=True).encode('utf-8')
+    info = tarfile.TarInfo('info/index.json')
+    info.size = len(data)
+    info.mtime = record['timestamp'] // 1000
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:bz2') as t:
+        t.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _make_records(task):
+    """Make the records of packages `start` to `stop` of a channel with
+    `num_names` package names
+
+    Returns
+    -------
+    list of (file name, record, package)
+    """
+    start, stop, num_names, platform = task
+    records = []
+    for num in range(start, stop):
+        name = 'package-%05d' % (num % num_names)
+        version = '%d.%d.%d' % (num // num_names // 100,
+                                num // num_names // 10 % 10,
+                                num // num_names % 10)
+        build = 'h%06x_0' % (num % 0xffffff)
+        record = {
+            'name': name,
+            'version': version,
+            'build': build,
+            'build_number': 0,
+            'depends': ['python >=3.6',
+                        'package-%05d' % ((num * 7 + 1) % num_names)],
+            'license': 'BSD-3-Clause',
+            'subdir': platform,
+            'timestamp': 1500000000000 + num * 1000,
+        }
+        package = _make_package(record)
+        record['md5'] = hashlib.md5(package).hexdigest()
+        record['sha256'] = hashlib.sha256(package).hexdigest()
+        record['size'] = len(package)
+        records.append(('%s-%s-%s.tar.bz2' % (name, version, build), record,
+                        package))
+    return records
+
+
+def make_channel(directory, num_records, platform='linux-64',
+                 chunk_size=1000):
+    """Generate a channel with `num_records` packages in `directory`, unless
+    it is there already
+
+    The packages are concatenated into a single packages.bin file, with their
+    offsets in packages.index, so that a channel with a million packages does
+    not need a million files. See `serve_channel`.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to generate the channel in
+    num_records : int
+        The number of packages in the channel
+    platform : str, optional
+        The platform of the packages. An empty noarch platform is generated
+        as well.
+
+    Returns
+    -------
+    str
+        The path of the channel
+    """
+    channel = os.path.join(directory, 'channel-%s' % num_records)
+    done = os.path.join(channel, 'done')
+    if os.path.exists(done):
+        return channel
+    if os.path.exists(channel):
+        shutil.rmtree(channel)
+    for subdir in (platform, 'noarch'):
+        os.makedirs(os.path.join(channel, subdir))
+    with open(os.path.join(channel, 'noarch', 'repodata.json'), 'w') as f:
+        json.dump({'info': {'subdir': 'noarch'}, 'packages': {}}, f)
+    platform_dir = os.path.join(channel, platform)
+    # a realistic channel has a couple of dozen versions of each package
+    num_names = max(num_records // 25, 1)
+    tasks = [(start, min(start + chunk_size, num_records), num_names,
+              platform)
+             for start in range(0, num_records, chunk_size)]
+    offset = 0
+    compressor = bz2.BZ2Compressor()
+    with multiprocessing.Pool() as pool, \
+            open(os.path.join(platform_dir, 'repodata.json'), 'wb') as rd, \
+            open(os.path.join(platform_dir, 'repodata.json.bz2'),
+                 'wb') as rd_bz2, \
+            open(os.path.join(channel, 'packages.bin'), 'wb') as packages, \
+            open(os.path.join(channel, 'packages.index'), 'w') as index:
+
+        def write(data):
+            data = data.encode('utf-8')
+            rd.write(data)
+            rd_bz2.write(compressor.compress(data))
+
+        # the repodata is written one record at a time, because the whole of
+        # it does not fit into memory for the larger channels
+        write('{"info": {"subdir": "%s"}, "packages": {' % platform)
+        separator = '\n'
+        for records in pool.imap(_make_records, tasks):
+            for file_name, record, package in records:
+                write('%s%s: %s' % (separator, json.dumps(file_name),
+                                    json.dumps(record, sort_keys=True)))
+                separator = ',\n'
+                packages.write(package)
+                index.write('%s %s %s\n' % (file_name, offset, len(package)))
+                offset += len(package)
+        write('\n}}\n')
+        rd_bz2.write(compressor.flush())
+    open(done, 'w').close()
+    return channel
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve_channel(channel, connection):
+    """Serve `channel` over http on a free local port, until the process is
+    terminated
+
+    The port is sent through `connection`.
+    """
+    index = {}
+    with open(os.path.join(channel, 'packages.index')) as f:
+        for line in f:
+            file_name, offset, size = line.split()
+            index[file_name] = (int(offset), int(size))
+    packages_path = os.path.join(channel, 'packages.bin')
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            entry = index.get(self.path.rsplit('/', 1)[-1])
+            if entry is None:
+                # repodata.json
+                return http.server.SimpleHTTPRequestHandler.do_GET(self)
+            offset, size = entry
+            with open(packages_path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(size)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-tar')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    # the channel is served from /channel, like the channels of anaconda.org
+    os.chdir(os.path.dirname(channel))
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    connection.send('http://127.0.0.1:%s/%s' % (server.server_address[1],
+                                                os.path.basename(channel)))
+    server.serve_forever()
+
+
+def _peak_rss(children=False):
+    """The peak resident set size in MB of this process or the largest of
+    its children"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else
+                                 resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == 'darwin':
+        max_rss /= 1024
+    return max_rss / 1024
+
+
+def _run(connection, kwargs):
+    """Run `conda_mirror.main` with `kwargs` and send the results through
+    `connection`"""
+    logging.basicConfig(
+        level=[logging.ERROR, logging.WARNING, logging.INFO,
+               logging.DEBUG][min(kwargs.pop('verbosity'), 3)],
+        format='%(levelname)s: %(message)s')
+    conda_mirror.logger = logging.getLogger('conda_mirror')
+    start_time = time.monotonic()
+    summary = conda_mirror.main(**kwargs)
+    connection.send({
+        'seconds': time.monotonic() - start_time,
+        'peak_rss_mb': _peak_rss(),
+        'workers_peak_rss_mb': _peak_rss(children=True),
+        'downloaded': len(summary['downloaded']),
+        'download-stats': summary['download-stats'],
+        'repodata': summary['repodata'],
+        'phases': summary['phases'],
+        'validation-stats': summary['validation-stats'],
+    })
+
+
+def _phase_rates(result, num_records):
+    """Describe the throughput of each phase of a run"""
+    validation = result['validation-stats']
+    items = {
+        'fetch-repodata': (num_records, 'records'),
+        'filter': (num_records, 'records'),
+        'validate-existing': (validation['existing']['files'], 'packages'),
+        'download': (result['downloaded'], 'packages'),
+        'validate-new': (validation['new']['files'], 'packages'),
+        'write-repodata': (num_records, 'records'),
+        'publish': (result['downloaded'], 'packages'),
+    }
+    rates = []
+    for phase in conda_mirror.PHASES:
+        seconds = result['phases'].get(phase, 0)
+        count, unit = items[phase]
+        rate = ''
+        if seconds and count:
+            rate = '%.0f %s/s' % (count / seconds, unit)
+        if phase == 'download' and seconds:
+            rate += ', %.2f MB/s' % (
+                result['download-stats'].get('bytes', 0) / seconds / 1e6)
+        rates.append((phase, seconds, rate))
+    return rates
+
+
+def run_benchmark(num_records, directory, platform='linux-64',
+                  validation_level='hash', num_download_threads=8,
+                  num_threads=0, verbosity=0, report=print):
+    """Mirror a synthetic channel with `num_records` packages
+
+    Parameters
+    ----------
+    num_records : int
+        The number of packages in the channel
+    directory : str
+        The directory to keep the channels in
+    platform : str, optional
+    validation_level : str, optional
+        The validation level of the runs with validation
+    num_download_threads : int, optional
+    num_threads : int, optional
+        The number of validation processes. Defaults to 0, one per cpu.
+    verbosity : int, optional
+        The verbosity of the log of conda-mirror, see `-v`
+    report : callable, optional
+        Called with each line of the report
+
+    Returns
+    -------
+    dict
+        The results of each run, keyed on the name of the run
+    """
+    start_time = time.monotonic()
+    channel = make_channel(directory, num_records, platform)
+    report('Generated the channel with %s records in %s in %.1fs'
+           % (num_records, channel, time.monotonic() - start_time))
+    # fresh processes, so that every run has its own peak RSS
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    server = context.Process(target=serve_channel, args=(channel, sender),
+                             daemon=True)
+    server.start()
+    results = {}
+    try:
+        channel_url = receiver.recv()
+        work_directory = tempfile.mkdtemp(dir=directory)
+        try:
+            for name, kwargs in RUNS:
+                target_directory = os.path.join(work_directory, 'mirror')
+                if name != 'resync':
+                    shutil.rmtree(target_directory, ignore_errors=True)
+                kwargs = dict({
+                    'upstream_channel': channel_url,
+                    'target_directory': target_directory,
+                    'temp_directory': work_directory,
+                    'platform': platform,
+                    'num_threads': num_threads,
+                    'num_download_threads': num_download_threads,
+                    'existing_validation_level': validation_level,
+                    'new_validation_level': validation_level,
+                    'validation_cache': False,
+                    'minimum_free_space': 0,
+                    'verbosity': verbosity,
+                }, **kwargs)
+                run_receiver, run_sender = context.Pipe(duplex=False)
+                run = context.Process(target=_run, args=(run_sender, kwargs))
+                run.start()
+                run_sender.close()
+                try:
+                    result = run_receiver.recv()
+                except EOFError:
+                    raise RuntimeError('The %s run of %s records failed'
+                                       % (name, num_records))
+                finally:
+                    run.join()
+                results[name] = result
+                report('%s records, %s: %.1fs, peak RSS %.0fMB (validation '
+                       'workers %.0fMB), %s packages downloaded'
+                       % (num_records, name, result['seconds'],
+                          result['peak_rss_mb'] or 0,
+                          result['workers_peak_rss_mb'] or 0,
+                          result['downloaded']))
+                for phase, seconds, rate in _phase_rates(result,
+                                                         num_records):
+                    report('    %-18s %8.2fs  %s' % (phase, seconds, rate))
+        finally:
+            shutil.rmtree(work_directory)
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--records', nargs='+', type=int, default=[10000],
+                    help='The number of records in the synthetic channels')
+    ap.add_argument('--directory',
+                    default=os.path.join(tempfile.gettempdir(),
+                                         'conda-mirror-benchmark'),
+                    help='Where to keep the generated channels')
+    ap.add_argument('--platform', default='linux-64')
+    ap.add_argument('--validation-level', default='hash',
+                    choices=conda_mirror.VALIDATION_LEVELS,
+                    help='The validation level of the runs with validation')
+    ap.add_argument('--num-download-threads', type=int, default=8)
+    ap.add_argument('--num-threads', type=int, default=0,
+                    help='Num of validation processes. 0 for one per cpu.')
+    ap.add_argument('--json', help='Write the results to this json file')
+    ap.add_argument('-v', '--verbose', action='count', default=0,
+                    help='The verbosity of the log of conda-mirror')
+    args = ap.parse_args()
+    os.makedirs(args.directory, exist_ok=True)
+    results = {}
+    for num_records in args.records:
+        results[num_records] = run_benchmark(
+            num_records, args.directory, args.platform, args.validation_level,
+            args.num_download_threads, args.num_threads, args.verbose)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,30 @@
 import bz2
+import collections
+import concurrent.futures
 import copy
+import errno
+import fnmatch
+import hashlib
+import http.server
+import io
 import itertools
 import json
 import os
+import pstats
+import shutil
 import sys
+import tarfile
+import threading
+import time
+import zipfile
 
 from os.path import join
 
 from conda_mirror import conda_mirror
 
+import benchmark_mirror
 import pytest
+import requests
 
 
 anaconda_channel = 'https://repo.continuum.io/pkgs/free'
@@ -175,3 +190,1052 @@ def test_dry_run_dumb(tmpdir):
         dry_run=True
     )
     assert len(ret['to-mirror']) > 1, "We should have a great deal of packages slated to download"
+
+
+def test_diff_repodata():
+    old = {'a-1-0.tar.bz2': {'md5': 'aaa', 'size': 1},
+           'b-1-0.tar.bz2': {'md5': 'bbb', 'size': 2},
+           'c-1-0.tar.bz2': {'md5': 'ccc', 'size': 3}}
+    new = {'b-1-0.tar.bz2': {'md5': 'bbb', 'size': 2},
+           'c-1-0.tar.bz2': {'md5': 'ddd', 'size': 3},
+           'd-1-0.tar.bz2': {'md5': 'eee', 'size': 4}}
+    added, removed, changed = conda_mirror._diff_repodata(old, new)
+    assert added == {'d-1-0.tar.bz2'}
+    assert removed == {'a-1-0.tar.bz2'}
+    assert changed == {'c-1-0.tar.bz2'}
+
+
+def test_validation_cache(tmpdir):
+    pkg = tmpdir.join('a-1-0.tar.bz2')
+    pkg.write('not really a package')
+    metadata = {'md5': 'aaa', 'size': 20}
+    cache = conda_mirror._ValidationCache(tmpdir.join('cache', 'v.sqlite').strpath)
+    assert not cache.is_valid(pkg.strpath, metadata)
+    cache.add([(pkg.strpath, metadata)])
+    assert cache.is_valid(pkg.strpath, metadata)
+    # a new upstream hash invalidates the record
+    assert not cache.is_valid(pkg.strpath, {'md5': 'bbb', 'size': 20})
+    # and so does changing the file
+    pkg.write('not really a package either')
+    assert not cache.is_valid(pkg.strpath, metadata)
+    cache.close()
+
+
+def test_hash_file(tmpdir):
+    f = tmpdir.join('data')
+    data = os.urandom(3 * 1024 + 17)
+    f.write_binary(data)
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    assert conda_mirror._hash_file(f.strpath, [md5, sha256], chunk_size=1024) == len(data)
+    assert md5.hexdigest() == hashlib.md5(data).hexdigest()
+    assert sha256.hexdigest() == hashlib.sha256(data).hexdigest()
+
+    md5 = hashlib.md5()
+    assert conda_mirror._hash_file(f.strpath, [md5], chunk_size=1024, end=1500) == 1500
+    assert md5.hexdigest() == hashlib.md5(data[:1500]).hexdigest()
+
+
+def _write_package(path, name='a', version='1'):
+    index = json.dumps({'name': name, 'version': version}).encode()
+    with tarfile.open(path, 'w:bz2') as t:
+        info = tarfile.TarInfo('info/index.json')
+        info.size = len(index)
+        t.addfile(info, io.BytesIO(index))
+    with open(path, 'rb') as f:
+        data = f.read()
+    return {'name': name, 'version': version, 'size': len(data),
+            'md5': hashlib.md5(data).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest()}
+
+
+def _write_conda_package(path, name='a', version='1', index=True):
+    """Write a .conda package, which needs zstandard"""
+    zstd = conda_mirror.zstandard.ZstdCompressor()
+
+    def tar_zst(members):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as t:
+            for member_name, data in members:
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                t.addfile(info, io.BytesIO(data))
+        return zstd.compress(buf.getvalue())
+
+    info = [('info/about.json', b'{}')]
+    if index:
+        info.append(('info/index.json', json.dumps(
+            {'name': name, 'version': version}).encode()))
+    stem = os.path.basename(path)[:-len('.conda')]
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('metadata.json', '{"conda_pkg_format_version": 2}')
+        z.writestr('info-%s.tar.zst' % stem, tar_zst(info))
+        z.writestr('pkg-%s.tar.zst' % stem, tar_zst([('lib/a', b'a')]))
+    with open(path, 'rb') as f:
+        data = f.read()
+    return {'name': name, 'version': version, 'size': len(data),
+            'md5': hashlib.md5(data).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest()}
+
+
+@pytest.mark.parametrize('level', conda_mirror.VALIDATION_LEVELS)
+def test_check_package_levels(tmpdir, level):
+    pkg = tmpdir.join('a-1-0.tar.bz2').strpath
+    metadata = _write_package(pkg)
+    reason, _ = conda_mirror._check_package(
+        pkg, md5=metadata['md5'], size=metadata['size'],
+        sha256=metadata['sha256'], level=level)
+    assert reason is None
+
+    # same size, different contents
+    with open(pkg, 'r+b') as f:
+        f.seek(-5, os.SEEK_END)
+        f.write(b'xxxxx')
+    reason, bytes_read = conda_mirror._check_package(
+        pkg, md5=metadata['md5'], size=metadata['size'], level=level)
+    if level == 'size':
+        assert reason is None
+        assert bytes_read == 0
+    else:
+        assert reason.startswith('Failed md5 validation')
+        assert bytes_read == metadata['size']
+
+
+def test_check_conda_archive(tmpdir):
+    pkg = tmpdir.join('a-1-0.conda').strpath
+    with zipfile.ZipFile(pkg, 'w') as z:
+        z.writestr('metadata.json', '{"conda_pkg_format_version": 2}')
+        z.writestr('info-a-1-0.tar.zst', b'')
+    reason, _ = conda_mirror._check_package(pkg, level='deep')
+    assert reason == 'Missing .conda archive members'
+
+    with open(pkg, 'wb') as f:
+        f.write(b'not a zip file')
+    reason, _ = conda_mirror._check_package(pkg, level='deep')
+    assert reason == 'Zipfile read failure'
+
+    if conda_mirror.zstandard is None:
+        return
+    metadata = _write_conda_package(pkg)
+    reason, bytes_read = conda_mirror._check_package(
+        pkg, md5=metadata['md5'], size=metadata['size'], level='deep')
+    assert reason is None
+    assert bytes_read > metadata['size']
+    _write_conda_package(pkg, index=False)
+    reason, _ = conda_mirror._check_package(pkg, level='deep')
+    assert reason == 'Missing info/index.json'
+
+
+def test_write_repodata_sections(tmpdir):
+    packages = {'a-1-0.tar.bz2': {'name': 'a'}, 'b-1-0.conda': {'name': 'b'}}
+    conda_mirror._write_repodata(tmpdir.strpath,
+                                 {'info': {}, 'packages': packages})
+    with open(tmpdir.join('repodata.json').strpath) as f:
+        repodata = json.load(f)
+    assert repodata['packages'] == {'a-1-0.tar.bz2': {'name': 'a'}}
+    assert repodata['packages.conda'] == {'b-1-0.conda': {'name': 'b'}}
+    assert conda_mirror._read_local_repodata(tmpdir.strpath) == packages
+
+
+@pytest.mark.parametrize('compression_threads', [1, 3])
+def test_write_repodata_streaming(tmpdir, compression_threads):
+    packages = {'pkg%d-1.0-0.tar.bz2' % i: {
+        'name': 'pkg%d' % i, 'version': '1.0', 'license': 'caf\xe9',
+        'depends': ['python >=3.6', 'numpy'], 'size': i} for i in range(2000)}
+    _, records = _parse_repodata({'packages': packages})
+    repodata = {'info': {'subdir': 'linux-64'}, 'packages': records}
+    conda_mirror._write_repodata(tmpdir.strpath, repodata,
+                                 compression_threads)
+
+    expected = json.dumps({'info': {'subdir': 'linux-64'},
+                           'packages': {name: dict(info, subdir='linux-64')
+                                        for name, info in packages.items()}},
+                          indent=2, sort_keys=True) + '\n'
+    with open(tmpdir.join('repodata.json').strpath, 'rb') as f:
+        assert f.read() == expected.encode('utf-8')
+    with open(tmpdir.join('repodata.json.bz2').strpath, 'rb') as f:
+        assert bz2.decompress(f.read()) == expected.encode('utf-8')
+
+
+def _parse_repodata(repodata, chunk_size=7, **kwargs):
+    data = json.dumps(repodata, ensure_ascii=False).encode('utf-8')
+    chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    return conda_mirror._parse_repodata(chunks, 'linux-64', **kwargs)
+
+
+def test_blacklisted_packages():
+    packages = {}
+    for name, version, build in itertools.product(
+            ['numpy', 'NumPy-base', 'scipy', 'python'], ['1.0', '1.1', '2.0'],
+            ['py27_0', 'py35_0']):
+        packages['%s-%s-%s.tar.bz2' % (name, version, build)] = {
+            'name': name, 'version': version, 'build': build}
+    blacklist = [{'name': 'numpy*'},
+                 {'name': 'scipy', 'version': '1.*'},
+                 {'version': '2.0', 'build': 'py27_0'},
+                 {'name': 's*', 'build': '*35*'}]
+    whitelist = [{'name': 'numpy', 'version': '1.1'},
+                 {'build': 'py35*'}]
+
+    def reference(rules):
+        matched = set()
+        for rule in rules:
+            matched.update(
+                pkg_name for pkg_name, pkg_info in packages.items()
+                if all(fnmatch.fnmatch(str(pkg_info.get(k, '')).lower(),
+                                       v.lower()) for k, v in rule.items()))
+        return matched
+
+    def blacklisted(blacklist, whitelist=None):
+        names = set()
+        _, kept = _parse_repodata({'packages': packages}, blacklist=blacklist,
+                                  whitelist=whitelist, blacklisted=names)
+        assert set(kept) == set(packages) - names
+        return names
+
+    names = blacklisted(blacklist, whitelist)
+    assert names == reference(blacklist) - reference(whitelist)
+    assert 'numpy-1.0-py27_0.tar.bz2' in names
+    assert 'NumPy-base-2.0-py27_0.tar.bz2' in names
+    assert 'scipy-1.0-py35_0.tar.bz2' not in names
+    assert blacklisted(None, whitelist) == set()
+    assert blacklisted([{}]) == set(packages)
+
+
+def test_version_order():
+    versions = ['0.4', '0.4.1.rc', '0.4.1', '0.5a1', '0.5b3', '0.5z', '0.5_5',
+                '0.9.6', '1.1dev1', '1.1a1', '1.1.0dev1', '1.1.0rc1', '1.1.0',
+                '1.1.0post1', '1.1post1', '1.10', '1!0.1']
+    orders = [conda_mirror._VersionOrder(v) for v in versions]
+    assert orders == sorted(orders)
+    assert conda_mirror._VersionOrder('1.1') == \
+        conda_mirror._VersionOrder('1.1.0')
+    assert conda_mirror._VersionOrder('1.1.dev1') == \
+        conda_mirror._VersionOrder('1.1.0DEV1')
+
+
+@pytest.mark.parametrize('rule,expected', [
+    # pre-releases sort before the release, like in conda
+    ({'name': 'numpy', 'version': '>=1.20, <2'},
+     {'numpy-1.20.1', 'numpy-2.0rc1'}),
+    ({'version': '<1.0|>=2.0a0'}, {'numpy-2.0rc1', 'scipy-0.19'}),
+    ({'version': '==1.*'}, {'numpy-1.20.1', 'numpy-1.9'}),
+    # conda's "=1.2" is "1.2.*"
+    ({'version': '=1'}, {'numpy-1.20.1', 'numpy-1.9'}),
+    ({'version': '=1.2'}, set()),
+    ({'version': '=1.20'}, {'numpy-1.20.1'}),
+    ({'version': '=1.9.*|=0.19'}, {'numpy-1.9', 'scipy-0.19'}),
+    ({'build_number': '=2'}, {'numpy-1.9'}),
+    ({'build_number': '>3'}, {'numpy-1.20.1'}),
+    ({'size': '>=100', 'name': 'numpy*'}, {'numpy-1.20.1', 'numpy-2.0rc1'}),
+    ({'any': [{'name': 'scipy'}, {'build_number': '<=0'}]},
+     {'scipy-0.19', 'numpy-2.0rc1'}),
+    ({'all': [{'name': 'numpy'}, {'size': '<100'}]}, {'numpy-1.9'}),
+    ({'name': 'numpy', 'not': {'version': '>=1.20'}}, {'numpy-1.9'}),
+])
+def test_package_rules(rule, expected):
+    packages = [
+        {'name': 'numpy', 'version': '1.9', 'build_number': 2, 'size': 10},
+        {'name': 'numpy', 'version': '1.20.1', 'build_number': 4,
+         'size': 500},
+        {'name': 'numpy', 'version': '2.0rc1', 'build_number': 0,
+         'size': 100},
+        {'name': 'scipy', 'version': '0.19', 'build_number': 1},
+    ]
+    rules = conda_mirror._PackageRules([rule])
+    matched = {'%s-%s' % (p['name'], p['version'])
+               for p in packages if rules.matches(p)}
+    assert matched == expected
+
+
+def test_package_rules_invalid():
+    with pytest.raises(ValueError):
+        conda_mirror._PackageRules([{'version': '>=1.0,~2'}])
+
+
+def test_package_records():
+    packages = {
+        'a-1-0.tar.bz2': {'name': 'a', 'version': '1', 'license': 'MIT',
+                          'depends': ['python >=3.6'], 'channel': 'x'},
+        'b-1-0.tar.bz2': {'name': 'b', 'version': '1', 'license': 'MIT',
+                          'depends': ['python >=3.6'], 'subdir': 'noarch'},
+    }
+    expected = copy.deepcopy(packages)
+    _, records = _parse_repodata({'packages': packages})
+    a, b = records['a-1-0.tar.bz2'], records['b-1-0.tar.bz2']
+    assert a.depends is b.depends
+    assert a['depends'] == ['python >=3.6']
+    assert a.get('md5') is None
+    assert dict(a) == dict(expected['a-1-0.tar.bz2'], subdir='linux-64')
+    assert b == expected['b-1-0.tar.bz2']
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 5, 6, 10, 15, 30, 64 * 1024])
+def test_parse_repodata(chunk_size):
+    repodata = {
+        'info': {'subdir': 'linux-64'},
+        # the chunks end in the middle of some of these numbers
+        'x': 1.5e10,
+        'repodata_version': 12345,
+        'packages': {'a-1-0.tar.bz2': {'name': 'a', 'size': 123456789,
+                                       'license': 'caf\xe9 \u2603'}},
+        'packages.conda': {'b-1-0.conda': {'name': 'b', 'depends': []}},
+        'removed': ['c-1-0.tar.bz2'],
+    }
+    info, packages = _parse_repodata(repodata, chunk_size)
+    assert info == {'subdir': 'linux-64'}
+    assert dict(packages['a-1-0.tar.bz2']) == {
+        'name': 'a', 'size': 123456789, 'license': 'caf\xe9 \u2603',
+        'subdir': 'linux-64'}
+    assert set(packages) == {'a-1-0.tar.bz2', 'b-1-0.conda'}
+
+    with pytest.raises(ValueError):
+        conda_mirror._parse_repodata([b'{"packages": {"a": {}'], 'linux-64')
+    with pytest.raises(ValueError):
+        conda_mirror._parse_repodata([b'{} {}'], 'linux-64')
+
+
+def test_json_stream_numbers():
+    data = b'{"x": 1.5e10, "y": -25, "z": [0.125], "t": true}'
+    for chunk_size in range(1, len(data) + 1):
+        stream = conda_mirror._JSONStream(
+            data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+        assert {key: stream.value() for key in stream.members()} == {
+            'x': 1.5e10, 'y': -25, 'z': [0.125], 't': True}
+        stream.close()
+
+
+def test_move_across_filesystems(tmpdir, monkeypatch):
+    src = tmpdir.join('src.tar.bz2')
+    src.write_binary(os.urandom(3 * 1024 * 1024 + 7))
+    data = src.read_binary()
+    dst = tmpdir.mkdir('target').join('dst.tar.bz2')
+    conda_mirror._copy_file(src.strpath, dst.strpath)
+    assert dst.read_binary() == data
+    dst.remove()
+
+    def replace(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(conda_mirror.os, 'replace', replace)
+    conda_mirror._move(src.strpath, dst.strpath)
+    assert dst.read_binary() == data
+    assert not src.exists()
+
+    assert conda_mirror._staging_directory(
+        tmpdir.strpath, tmpdir.join('target').strpath) == tmpdir.strpath
+
+
+def test_blob_store(tmpdir):
+    store = conda_mirror._BlobStore(tmpdir.join('blobs').strpath)
+    pkg = tmpdir.mkdir('linux-64').join('a-1-0.tar.bz2').strpath
+    metadata = _write_package(pkg)
+    target = tmpdir.mkdir('osx-64').join('a-1-0.tar.bz2').strpath
+    assert not store.link(metadata, target)
+
+    store.add(metadata, pkg)
+    assert store.link(metadata, target)
+    assert os.path.samefile(pkg, target)
+    # found by md5 alone, but not if the size does not match
+    other = tmpdir.join('b-1-0.tar.bz2').strpath
+    assert store.link({'md5': metadata['md5']}, other)
+    assert not store.link(dict(metadata, size=1), tmpdir.join('c').strpath)
+
+    # a corrupt blob is removed from the store instead of being linked
+    with open(pkg, 'r+b') as f:
+        f.write(b'corrupt')
+    corrupt = tmpdir.join('d-1-0.tar.bz2')
+    assert not store.link(metadata, corrupt.strpath)
+    assert not corrupt.exists()
+    assert not any(os.path.exists(path)
+                   for path in store._blob_paths(metadata))
+
+
+@pytest.mark.parametrize('num_threads', [1, 2])
+def test_validate_packages(tmpdir, num_threads):
+    package_repodata = {}
+    for i in range(5):
+        name = 'a-%d-0.tar.bz2' % i
+        package_repodata[name] = _write_package(tmpdir.join(name).strpath,
+                                                version=str(i))
+    tmpdir.join('a-0-0.tar.bz2').write_binary(b'corrupt')
+    tmpdir.join('b-1-0.tar.bz2').write_binary(b'not upstream')
+    results = conda_mirror._validate_packages(
+        package_repodata, tmpdir.strpath, num_threads=num_threads)
+    reasons = {os.path.basename(path): reason for path, reason in results}
+    assert len(reasons) == 6
+    assert reasons['a-0-0.tar.bz2'].endswith('Failed size test')
+    assert reasons['b-1-0.tar.bz2'].endswith('not in the repodata index')
+    assert sorted(os.listdir(tmpdir.strpath)) == [
+        'a-%d-0.tar.bz2' % i for i in range(1, 5)]
+
+
+@pytest.mark.parametrize('order,expected', [
+    ('name', ['a', 'b', 'c', 'd']),
+    ('smallest-first', ['c', 'a', 'd', 'b']),
+    ('newest-first', ['d', 'b', 'a', 'c']),
+    ('whitelist-first', ['b', 'd', 'a', 'c']),
+])
+def test_order_downloads(order, expected):
+    packages = {'a': {'name': 'a', 'size': 20, 'timestamp': 2},
+                'b': {'name': 'b', 'size': 40, 'timestamp': 3},
+                'c': {'name': 'c', 'size': 10},
+                'd': {'name': 'd', 'size': 30, 'timestamp': 4}}
+    whitelist = [{'name': 'b'}, {'name': 'd'}]
+    assert conda_mirror._order_downloads(
+        packages, packages, order, whitelist) == expected
+
+
+def test_parse_bandwidth_limits():
+    assert conda_mirror._parse_bandwidth_limits(None) == (None, [])
+    assert conda_mirror._parse_bandwidth_limits(
+        ['10M', '09:00-17:30=512k', '22:00-06:00=1.5G']) == (
+            10 * 1024 ** 2, [(9 * 60, 17 * 60 + 30, 512 * 1024),
+                             (22 * 60, 6 * 60, 1.5 * 1024 ** 3)])
+    assert conda_mirror._parse_bandwidth_limits(1000) == (1000, [])
+    with pytest.raises(ValueError):
+        conda_mirror._parse_bandwidth_limits(['10 mbit'])
+    with pytest.raises(ValueError):
+        conda_mirror._parse_bandwidth_limits(['9-17=10M'])
+
+
+def test_scheduler_throttle(monkeypatch):
+    clock = [100.]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        clock[0] += seconds
+    monkeypatch.setattr(conda_mirror.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(conda_mirror.time, 'sleep', sleep)
+    scheduler = conda_mirror._DownloadScheduler(['1000'])
+    # the bucket starts out empty
+    scheduler.throttle(500)
+    scheduler.throttle(500)
+    assert waits == [0.5, 0.5]
+    # it holds a second worth of bytes at most
+    clock[0] += 10
+    scheduler.throttle(800)
+    scheduler.throttle(400)
+    assert waits == [0.5, 0.5, 0.2]
+    # downloads that go into debt at the same time, while the clock stands
+    # still, queue up behind each other
+    del waits[:]
+    monkeypatch.setattr(conda_mirror.time, 'sleep', waits.append)
+    scheduler = conda_mirror._DownloadScheduler(['1000'])
+    scheduler.throttle(1000)
+    scheduler.throttle(1000)
+    assert waits == [1., 2.]
+
+    # the limit of a time of day range applies within it
+    del waits[:]
+    monkeypatch.setattr(conda_mirror.time, 'localtime', lambda: (
+        time.struct_time((2020, 1, 1, 10, 30, 0, 2, 1, -1))))
+    scheduler = conda_mirror._DownloadScheduler(['1000', '09:00-17:00=100'])
+    scheduler.throttle(50)
+    assert waits == [0.5]
+    del waits[:]
+    scheduler = conda_mirror._DownloadScheduler(['09:00-10:00=100'])
+    scheduler.throttle(50)
+    assert waits == []
+
+
+def test_scheduler_connections():
+    scheduler = conda_mirror._DownloadScheduler(max_connections_per_host=2)
+    lock = threading.Lock()
+    running = collections.Counter()
+    most_running = collections.Counter()
+
+    def download(url):
+        host = url.split('/')[2]
+        with scheduler.connection(url):
+            with lock:
+                running[host] += 1
+                most_running[host] = max(most_running[host], running[host])
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+
+    urls = ['http://%s/a-%d-0.tar.bz2' % (host, i)
+            for host in ('a.org', 'b.org') for i in range(6)]
+    with concurrent.futures.ThreadPoolExecutor(len(urls)) as pool:
+        list(pool.map(download, urls))
+    assert most_running == {'a.org': 2, 'b.org': 2}
+
+
+def test_disk_budget(tmpdir, monkeypatch):
+    usage = shutil.disk_usage(str(tmpdir))
+    free = [100]
+    monkeypatch.setattr(shutil, 'disk_usage',
+                        lambda path: usage._replace(free=free[0]))
+    download_dir = tmpdir.mkdir('download')
+    local_directory = tmpdir.mkdir('local')
+    packages = {'a': {'size': 50}, 'b': {'size': 40}, 'c': {'size': 20},
+                'd': {}}
+    budget = conda_mirror._DiskBudget(minimum_free_space=20)
+    # both directories are on the same filesystem, so they share 80 bytes
+    assert budget.plan(['b', 'a', 'c', 'd'], packages, str(download_dir),
+                       str(local_directory)) == (['b', 'c', 'd'], ['a'])
+    # the planned packages stay reserved until they are released
+    assert budget.plan(['a', 'c'], packages, str(download_dir),
+                       str(tmpdir)) == (['c'], ['a'])
+    budget.release(str(local_directory), 'b')
+    assert budget.plan(['a'], packages, str(download_dir),
+                       str(tmpdir)) == ([], ['a'])
+    with budget.reserving(str(local_directory)):
+        pass
+    assert budget.plan(['a'], packages, str(download_dir),
+                       str(tmpdir)) == (['a'], [])
+
+    # the bytes of a downloaded package are used instead of reserved
+    budget = conda_mirror._DiskBudget(minimum_free_space=20)
+    assert budget.plan(['a'], packages, str(download_dir),
+                       str(local_directory)) == (['a'], [])
+    free[0] -= 50
+    budget.staged(str(local_directory), 'a', str(download_dir))
+    assert budget.plan(['c'], packages, str(download_dir),
+                       str(tmpdir)) == (['c'], [])
+
+
+def test_format_metrics():
+    summary = {'phases': {}, 'download-stats': {}, 'disk-budget': {},
+               'repodata': {'transferred_bytes': 10, 'decoded_bytes': 20},
+               'validating-existing': {('a', None), ('b', 'bad md5')},
+               'validating-new': set(), 'to-mirror': {'c', 'd'},
+               'downloaded': {('url/c', 'dir')}, 'linked': set(),
+               'skipped': {'d'}, 'blacklisted': set(),
+               'validation-stats': {'new': {'files': 4, 'seconds': 2.,
+                                            'hits': 1, 'misses': 3}}}
+    with conda_mirror._phase(summary, 'download'):
+        with conda_mirror._phase(summary, 'filter'):
+            pass
+    conda_mirror._add_download_stats(summary['download-stats'], 1000, 0.01)
+    conda_mirror._add_download_stats(summary['download-stats'], 10 ** 6, 0.5)
+    assert set(summary['phases']) == {'download', 'filter'}
+    metrics = conda_mirror._format_metrics({'linux-64': summary}, 100., 160.,
+                                           True).splitlines()
+    for line in [
+            'conda_mirror_run_duration_seconds 60.0',
+            'conda_mirror_run_success 1',
+            'conda_mirror_phase_duration_seconds{platform="linux-64",'
+            'phase="publish"} 0',
+            'conda_mirror_packages{platform="linux-64",state="removed"} 1',
+            'conda_mirror_packages{platform="linux-64",state="skipped"} 1',
+            'conda_mirror_downloaded_bytes{platform="linux-64"} 1001000',
+            'conda_mirror_download_throughput_bytes_per_second_bucket{'
+            'platform="linux-64",le="262144.0"} 1',
+            'conda_mirror_download_throughput_bytes_per_second_bucket{'
+            'platform="linux-64",le="4194304.0"} 2',
+            'conda_mirror_download_throughput_bytes_per_second_bucket{'
+            'platform="linux-64",le="+Inf"} 2',
+            'conda_mirror_download_throughput_bytes_per_second_count{'
+            'platform="linux-64"} 2',
+            'conda_mirror_validation_files_per_second{platform="linux-64",'
+            'pass="new"} 2.0',
+            'conda_mirror_validation_cache_hit_ratio{platform="linux-64",'
+            'pass="new"} 0.25']:
+        assert line in metrics
+
+
+def test_serve_metrics():
+    server = conda_mirror._serve_metrics(0, lambda: 'conda_mirror_up 1\n')
+    try:
+        # only reachable from this host by default
+        host, port = server.server_address
+        assert host == '127.0.0.1'
+        response = requests.get('http://127.0.0.1:%s/metrics' % port)
+        assert response.text == 'conda_mirror_up 1\n'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _busy(n):
+    return sum(i * i for i in range(n))
+
+
+def test_profiler(tmpdir, monkeypatch):
+    profiler = conda_mirror._Profiler(str(tmpdir))
+    monkeypatch.setattr(conda_mirror, '_profiler', profiler)
+    summary = {'phases': {}}
+    with conda_mirror._phase(summary, 'download'):
+        with concurrent.futures.ThreadPoolExecutor(2) as pool:
+            list(pool.map(conda_mirror._profiled(_busy), [10000] * 4))
+        with conda_mirror._phase(summary, 'filter'):
+            _busy(10000)
+    profiler.dump()
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'download.pstats', 'filter.pstats', 'profile.collapsed']
+
+    def calls(phase):
+        stats = pstats.Stats(str(tmpdir.join(phase + '.pstats'))).stats
+        return sum(nc for (_, _, name), (_, nc, _, _, _) in stats.items()
+                   if name == '_busy')
+
+    # the nested phase pauses the profile of the outer one
+    assert calls('download') == 4
+    assert calls('filter') == 1
+    stacks = tmpdir.join('profile.collapsed').read().splitlines()
+    assert {stack.split(';')[0] for stack in stacks} == {'download', 'filter'}
+    assert any(stack.startswith('filter;_busy (test_conda_mirror.py:')
+               for stack in stacks)
+
+
+def test_benchmark(tmpdir):
+    report = []
+    results = benchmark_mirror.run_benchmark(
+        50, str(tmpdir), num_download_threads=2, num_threads=2,
+        report=report.append)
+    assert [name for name, _ in benchmark_mirror.RUNS] == [
+        'no-validation', 'validation', 'resync']
+    assert results['no-validation']['downloaded'] == 50
+    assert results['validation']['downloaded'] == 50
+    assert results['resync']['downloaded'] == 0
+    assert results['resync']['validation-stats']['existing']['files'] == 50
+    assert all(result['phases'] for result in results.values())
+    assert len(report) == 1 + 3 * (1 + len(conda_mirror.PHASES))
+
+
+class _ChannelHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the files of the server from memory, with support for
+    conditional and Range requests"""
+    protocol_version = 'HTTP/1.1'
+    last_modified = 'Sat, 01 Jan 2000 00:00:00 GMT'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        data = server.files.get(self.path)
+        if data is None:
+            return self._respond(server.missing_status)
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if server.weak_etags:
+            etag = 'W/' + etag
+        headers = {'ETag': etag, 'Last-Modified': self.last_modified}
+        # If-Modified-Since is ignored if If-None-Match is given, RFC 7232
+        if 'If-None-Match' in self.headers:
+            not_modified = self.headers['If-None-Match'] == etag
+        else:
+            not_modified = (self.headers.get('If-Modified-Since') ==
+                            self.last_modified)
+        if not_modified:
+            return self._respond(304, headers=headers)
+        byte_range = self.headers.get('Range')
+        if (byte_range and server.ranges and
+                self.headers.get('If-Range') in (etag, self.last_modified)):
+            start = int(byte_range[len('bytes='):-1])
+            if start >= len(data):
+                return self._respond(416)
+            headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                start, len(data) - 1, len(data))
+            return self._respond(206, data[start:], headers)
+        self._respond(200, data, headers)
+
+    def _respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    """A local http server for the files in its `files` dict"""
+    server = benchmark_mirror._ThreadingHTTPServer(('127.0.0.1', 0),
+                                                   _ChannelHandler)
+    server.files = {}
+    server.requests = []
+    server.missing_status = 404
+    server.weak_etags = False
+    server.ranges = True
+    server.url = 'http://127.0.0.1:%s' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _interrupted_download(server, partial_dir, data, received):
+    """Leave a download of `data` that was interrupted after `received`
+    bytes in `partial_dir`"""
+    server.files['/a-1-0.tar.bz2'] = data
+    url = server.url + '/a-1-0.tar.bz2'
+    response = requests.get(url)
+    partial = partial_dir.join('a-1-0.tar.bz2.part')
+    partial.write_binary(received)
+    conda_mirror._write_partial_download_state(partial.strpath, url,
+                                               response)
+    del server.requests[:]
+    return url
+
+
+@pytest.mark.parametrize('weak_etags', [False, True])
+def test_download_resume(tmpdir, server, weak_etags):
+    server.weak_etags = weak_etags
+    data = os.urandom(100000)
+    partial_dir = tmpdir.mkdir('partial')
+    url = _interrupted_download(server, partial_dir, data, data[:30000])
+    size, reason = conda_mirror._download(
+        url, tmpdir.strpath, session=requests.Session(),
+        partial_directory=partial_dir.strpath,
+        md5=hashlib.md5(data).hexdigest(),
+        sha256=hashlib.sha256(data).hexdigest(), size=len(data))
+    assert (size, reason) == (len(data), None)
+    assert tmpdir.join('a-1-0.tar.bz2').read_binary() == data
+    assert partial_dir.listdir() == []
+    (_, headers), = server.requests
+    assert headers['Range'] == 'bytes=30000-'
+    # weak etags cannot validate a Range request, Last-Modified is used
+    if weak_etags:
+        assert headers['If-Range'] == _ChannelHandler.last_modified
+    else:
+        assert headers['If-Range'] == '"%s"' % hashlib.md5(data).hexdigest()
+
+
+@pytest.mark.parametrize('ranges,changed,received,num_requests', [
+    # the server ignores the Range and sends the whole file
+    (False, False, 30000, 1),
+    # the file changed upstream, so its ETag does not match any more
+    (True, True, 30000, 1),
+    # the partial file is longer than the upstream file
+    (True, False, 200000, 2),
+], ids=['no-ranges', 'changed', 'too-long'])
+def test_download_restart(tmpdir, server, ranges, changed, received,
+                          num_requests):
+    server.ranges = ranges
+    data = os.urandom(100000)
+    partial_dir = tmpdir.mkdir('partial')
+    url = _interrupted_download(server, partial_dir,
+                                b'old' if changed else data,
+                                b'\0' * received)
+    server.files['/a-1-0.tar.bz2'] = data
+    size, reason = conda_mirror._download(
+        url, tmpdir.strpath, session=requests.Session(),
+        partial_directory=partial_dir.strpath,
+        md5=hashlib.md5(data).hexdigest())
+    assert (size, reason) == (len(data), None)
+    assert tmpdir.join('a-1-0.tar.bz2').read_binary() == data
+    assert len(server.requests) == num_requests
+
+
+def test_download_resume_corrupt(tmpdir, server):
+    # the bytes already on disk are part of the validated file
+    data = os.urandom(100000)
+    partial_dir = tmpdir.mkdir('partial')
+    url = _interrupted_download(server, partial_dir, data,
+                                b'\0' + data[1:30000])
+    size, reason = conda_mirror._download(
+        url, tmpdir.strpath, partial_directory=partial_dir.strpath,
+        md5=hashlib.md5(data).hexdigest())
+    assert size == len(data)
+    assert reason.startswith('Failed md5 validation')
+    assert not tmpdir.join('a-1-0.tar.bz2').exists()
+
+
+class _Response(object):
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+def test_is_resumed_response():
+    headers = {'Content-Range': 'bytes 10-99/100', 'ETag': '"a"'}
+    assert conda_mirror._is_resumed_response(_Response(206, headers), 10,
+                                             '"a"')
+    assert not conda_mirror._is_resumed_response(_Response(200, headers), 10,
+                                                 '"a"')
+    assert not conda_mirror._is_resumed_response(_Response(206, headers), 20,
+                                                 '"a"')
+    assert not conda_mirror._is_resumed_response(_Response(206, headers), 10,
+                                                 '"b"')
+    # a Last-Modified validator cannot be compared to the ETag
+    assert conda_mirror._is_resumed_response(
+        _Response(206, headers), 10, 'Sat, 01 Jan 2000 00:00:00 GMT')
+
+
+def _serve_channel(tmpdir, server, platform='linux-64', names=('a', 'b'),
+                   conda_names=()):
+    """Publish a channel with a .tar.bz2 package for each of `names` and a
+    .conda package for each of `conda_names` on `server`
+
+    Returns the url of the channel and the repodata of its packages.
+    """
+    upstream = tmpdir.ensure('upstream', platform, dir=True)
+    packages = {}
+    conda_packages = {}
+    for name in names:
+        file_name = '%s-1-0.tar.bz2' % name
+        packages[file_name] = _write_package(upstream.join(file_name).strpath,
+                                             name=name)
+    for name in conda_names:
+        file_name = '%s-1-0.conda' % name
+        conda_packages[file_name] = _write_conda_package(
+            upstream.join(file_name).strpath, name=name)
+    for file_name in itertools.chain(packages, conda_packages):
+        server.files['/channel/%s/%s' % (platform, file_name)] = (
+            upstream.join(file_name).read_binary())
+    repodata = {'info': {'subdir': platform}, 'packages': packages}
+    if conda_packages:
+        repodata['packages.conda'] = conda_packages
+        packages = dict(packages, **conda_packages)
+    server.files['/channel/%s/repodata.json' % platform] = json.dumps(
+        repodata).encode()
+    return server.url + '/channel', packages
+
+
+def test_get_repodata_cache(tmpdir, server):
+    channel, packages = _serve_channel(tmpdir, server)
+    cache_directory = tmpdir.join('cache').strpath
+    stats = {}
+    info, fetched = conda_mirror.get_repodata(
+        channel, 'linux-64', cache_directory=cache_directory, stats=stats)
+    assert set(fetched) == set(packages)
+    assert not stats['not_modified']
+    path, headers = server.requests[-1]
+    assert path == '/channel/linux-64/repodata.json'
+    assert 'If-None-Match' not in headers
+    assert 'If-Modified-Since' not in headers
+
+    # the validators of the cached copy are sent along, and the cached copy
+    # is read when the server says it did not change
+    del server.requests[:]
+    stats = {}
+    info, cached = conda_mirror.get_repodata(
+        channel, 'linux-64', cache_directory=cache_directory, stats=stats)
+    assert {name: dict(record) for name, record in cached.items()} == {
+        name: dict(record) for name, record in fetched.items()}
+    assert stats['not_modified']
+    assert stats['transferred_bytes'] == 0
+    assert stats['decoded_bytes'] == len(
+        server.files['/channel/linux-64/repodata.json'])
+    (path, headers), = server.requests
+    assert path == '/channel/linux-64/repodata.json'
+    assert headers['If-None-Match'] == stats['etag']
+    assert headers['If-Modified-Since'] == _ChannelHandler.last_modified
+
+    # the ETag tells that the repodata changed upstream
+    del packages['b-1-0.tar.bz2']
+    server.files['/channel/linux-64/repodata.json'] = json.dumps(
+        {'info': {'subdir': 'linux-64'}, 'packages': packages}).encode()
+    stats = {}
+    info, changed = conda_mirror.get_repodata(
+        channel, 'linux-64', cache_directory=cache_directory, stats=stats)
+    assert set(changed) == {'a-1-0.tar.bz2'}
+    assert not stats['not_modified']
+
+    # without the cached copy, its validators are worthless
+    cache_path = conda_mirror._repodata_cache_path(
+        cache_directory, channel + '/linux-64/repodata.json')
+    os.remove(cache_path)
+    del server.requests[:]
+    stats = {}
+    info, refetched = conda_mirror.get_repodata(
+        channel, 'linux-64', cache_directory=cache_directory, stats=stats)
+    assert set(refetched) == set(packages)
+    assert not stats['not_modified']
+    assert os.path.exists(cache_path)
+    assert all('If-None-Match' not in headers
+               for _, headers in server.requests)
+
+
+def test_mirror_state(tmpdir, server, monkeypatch):
+    channel, packages = _serve_channel(tmpdir, server)
+    target_directory = tmpdir.mkdir('target')
+    cache_directory = tmpdir.join('cache').strpath
+    state_path = conda_mirror._mirror_state_path(
+        cache_directory, target_directory.join('linux-64').strpath)
+
+    def mirror(**kwargs):
+        del server.requests[:]
+        return conda_mirror.main(
+            channel, target_directory.strpath, tmpdir.strpath, 'linux-64',
+            cache_directory=cache_directory, **kwargs)
+
+    # an incomplete run is not remembered, so that the next one retries
+    missing = server.files.pop('/channel/linux-64/b-1-0.tar.bz2')
+    summary = mirror()
+    assert len(summary['downloaded']) == 1
+    assert not os.path.exists(state_path)
+
+    server.files['/channel/linux-64/b-1-0.tar.bz2'] = missing
+    summary = mirror()
+    assert summary['repodata']['not_modified']
+    assert len(summary['downloaded']) == 1
+    assert os.path.exists(state_path)
+
+    # nothing changed, so nothing is downloaded
+    summary = mirror()
+    assert summary['repodata']['not_modified']
+    assert not summary['to-mirror']
+    assert [path for path, _ in server.requests] == [
+        '/channel/linux-64/repodata.json']
+    assert sorted(target_directory.join('linux-64').listdir()) == sorted(
+        target_directory.join('linux-64', name) for name in
+        ['a-1-0.tar.bz2', 'b-1-0.tar.bz2', 'repodata.json',
+         'repodata.json.bz2'])
+
+    # without validating the existing packages, the cached repodata is not
+    # even read
+    def parse_repodata(*args, **kwargs):
+        raise AssertionError('the repodata was parsed')
+    monkeypatch.setattr(conda_mirror, '_parse_repodata', parse_repodata)
+    for kwargs in ({'no_validate_target': True}, {'incremental': True}):
+        summary = mirror(**kwargs)
+        assert summary['repodata']['not_modified']
+        assert summary['repodata']['decoded_bytes'] == 0
+
+
+@pytest.mark.parametrize('missing_status', [403, 404])
+@pytest.mark.parametrize('compression', ['zst', 'bz2', None])
+def test_get_repodata_variants(tmpdir, server, compression, missing_status):
+    if compression == 'zst' and conda_mirror.zstandard is None:
+        pytest.skip('zstandard is not installed')
+    channel, packages = _serve_channel(tmpdir, server)
+    server.missing_status = missing_status
+    path = '/channel/linux-64/repodata.json'
+    data = server.files[path]
+    compressed = data
+    if compression is not None:
+        del server.files[path]
+        if compression == 'zst':
+            compressed = conda_mirror.zstandard.ZstdCompressor().compress(data)
+        else:
+            compressed = bz2.compress(data)
+        path += '.' + compression
+        server.files[path] = compressed
+    stats = {}
+    info, fetched = conda_mirror.get_repodata(channel, 'linux-64',
+                                              stats=stats)
+    assert set(fetched) == set(packages)
+    assert stats['url'] == server.url + path
+    assert stats['transferred_bytes'] == len(compressed)
+    assert stats['decoded_bytes'] == len(data)
+
+
+def test_get_repodata_missing(server):
+    server.missing_status = 403
+    with pytest.raises(requests.HTTPError):
+        conda_mirror.get_repodata(server.url + '/channel', 'linux-64')
+
+
+def test_main_platforms(tmpdir, server, monkeypatch):
+    channel, packages = _serve_channel(tmpdir, server, 'linux-64')
+    _serve_channel(tmpdir, server, 'osx-64', names=('c',))
+    calls = []
+    _mirror = conda_mirror._mirror
+
+    def mirror(*args, **kwargs):
+        calls.append((args[3], args[5], kwargs['executor'],
+                      kwargs['disk_budget'], kwargs['scheduler'],
+                      kwargs['validation_pool']))
+        return _mirror(*args, **kwargs)
+    monkeypatch.setattr(conda_mirror, '_mirror', mirror)
+
+    summaries = conda_mirror.main(
+        channel, tmpdir.mkdir('target').strpath, tmpdir.strpath,
+        ['linux-64', 'osx-64', 'linux-64'], num_download_threads=2,
+        num_threads=2, new_validation_level='deep')
+    assert sorted(summaries) == ['linux-64', 'osx-64']
+    assert sorted(call[0] for call in calls) == ['linux-64', 'osx-64']
+    # the platforms share one session, download pool, disk budget,
+    # scheduler and validation pool
+    assert calls[0][-1] is not None
+    assert all(call[1:] == calls[0][1:] for call in calls)
+    assert summaries['linux-64']['validation-stats']['new']['files'] == 2
+    assert summaries['osx-64']['validation-stats']['new']['files'] == 1
+    assert {os.path.basename(url) for url, _ in
+            summaries['linux-64']['downloaded']} == set(packages)
+    assert {os.path.basename(url) for url, _ in
+            summaries['osx-64']['downloaded']} == {'c-1-0.tar.bz2'}
+    assert (summaries['linux-64']['connections'] ==
+            summaries['osx-64']['connections'])
+    assert summaries['linux-64']['connections']['requests'] == len(
+        server.requests)
+
+
+def test_main_blob_store_corrupt(tmpdir, server):
+    channel, packages = _serve_channel(tmpdir, server)
+    target_directory = tmpdir.mkdir('target')
+    blob_store = tmpdir.join('blobs').strpath
+
+    def mirror():
+        return conda_mirror.main(
+            channel, target_directory.strpath, tmpdir.strpath, 'linux-64',
+            blob_store=blob_store)
+
+    mirror()
+    # corrupting a published package corrupts its blob as well
+    package = target_directory.join('linux-64', 'a-1-0.tar.bz2')
+    data = package.read_binary()
+    with open(package.strpath, 'r+b') as f:
+        f.write(b'corrupt')
+    summary = mirror()
+    assert [path for path, reason in summary['validating-existing']
+            if reason is not None] == [package.strpath]
+    # the blob is not linked back, the package is downloaded again
+    assert not summary['linked']
+    assert {os.path.basename(url) for url, _ in summary['downloaded']} == {
+        'a-1-0.tar.bz2'}
+    assert package.read_binary() == data
+    # and the fresh download went back into the store
+    store = conda_mirror._BlobStore(blob_store)
+    assert store.link(packages['a-1-0.tar.bz2'],
+                      tmpdir.join('a-1-0.tar.bz2').strpath)
+
+
+@pytest.mark.parametrize('level', ['size', 'hash'])
+def test_download_packages_level(tmpdir, server, level):
+    channel, packages = _serve_channel(tmpdir, server)
+    # a wrong md5 is only noticed if the packages are hashed
+    packages['a-1-0.tar.bz2']['md5'] = '0' * 32
+    download_dir = tmpdir.mkdir('download')
+    downloaded, validated = conda_mirror._download_packages(
+        [channel + '/linux-64/' + name for name in sorted(packages)],
+        download_dir.strpath, package_repodata=packages, level=level)
+    assert len(downloaded) == 2
+    reasons = {os.path.basename(path): reason for path, reason in validated}
+    assert reasons['b-1-0.tar.bz2'] is None
+    if level == 'size':
+        assert reasons['a-1-0.tar.bz2'] is None
+    else:
+        assert reasons['a-1-0.tar.bz2'].startswith('Failed md5 validation')
+
+
+def test_main_profile(tmpdir, server):
+    # the download threads and platforms are profiled at the same time
+    channel, packages = _serve_channel(tmpdir, server, 'linux-64')
+    _serve_channel(tmpdir, server, 'osx-64', names=('c',))
+    profile = tmpdir.join('profile')
+    conda_mirror.main(
+        channel, tmpdir.mkdir('target').strpath, tmpdir.strpath,
+        ['linux-64', 'osx-64'], num_download_threads=2, num_threads=2,
+        validation_cache=False, new_validation_level='deep',
+        profile=profile.strpath)
+    files = {path.basename for path in profile.listdir()}
+    assert {'download.pstats', 'validate-new.pstats',
+            'profile.collapsed'} <= files
+
+
+@pytest.mark.skipif(conda_mirror.zstandard is None,
+                    reason='zstandard is not installed')
+def test_main_conda_packages(tmpdir, server):
+    channel, packages = _serve_channel(tmpdir, server, conda_names=('c',))
+    target_directory = tmpdir.mkdir('target')
+    summary = conda_mirror.main(
+        channel, target_directory.strpath, tmpdir.strpath, 'linux-64',
+        new_validation_level='deep')
+    assert summary['to-mirror'] == set(packages)
+    assert {os.path.basename(url) for url, _ in summary['downloaded']} == (
+        set(packages))
+    assert {reason for _, reason in summary['validating-new']} == {None}
+    local_directory = target_directory.join('linux-64')
+    assert (local_directory.join('c-1-0.conda').read_binary() ==
+            tmpdir.join('upstream', 'linux-64', 'c-1-0.conda').read_binary())
+    repodata = json.loads(local_directory.join('repodata.json').read())
+    assert set(repodata['packages']) == {'a-1-0.tar.bz2', 'b-1-0.tar.bz2'}
+    assert set(repodata['packages.conda']) == {'c-1-0.conda'}